@@ -19,6 +19,14 @@
  *     IMServer.php?action=unset&key=KEYTOSET
  *     returns nothing
  *
+ *  MGET:
+ *     IMServer.php?action=mget&key[]=KEY1&key[]=KEY2...
+ *     returns a JSON array of the values, in the same order ("" if not set)
+ *
+ *  MSET:
+ *     IMServer.php?action=mset&key[]=KEY1&value[]=VALUE1&key[]=KEY2&value[]=VALUE2...
+ *     returns nothing
+ *
  */
 
 // Get parameters from query string
@@ -89,6 +97,25 @@ switch ($action)
     $_APP[$key] = $value;
     break;
 
+  case 'mget':
+    // Return several dictionary values in one go. Without key[] there are
+    // no keys, as in imlocal.py, rather than one empty key
+    $values = array();
+    foreach (is_array($key) ? $key : array() as $name) {
+        $values[] = isset($_APP[$name]) ? $_APP[$name] : '';
+    }
+    print json_encode($values);
+    break;
+
+  case 'mset':
+    // Set several dictionary values in one go, value[i] goes with key[i].
+    // A plain value rather than value[] would be indexed by character
+    $values = is_array($value) ? $value : array();
+    foreach (is_array($key) ? $key : array() as $i => $name) {
+        $_APP[$name] = isset($values[$i]) ? $values[$i] : '';
+    }
+    break;
+
   case 'unset':
     // Unset a dictionary item
     unset($_APP[$key]);
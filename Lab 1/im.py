@@ -1,31 +1,112 @@
 """
 
 Server proxy module, for providing local functions that execute the three remote
-functions of IMServer.php. That is: SET, GET and UNSET.
+functions of IMServer.php. That is: SET, GET and UNSET. get_many and set_many
+read or write several keys in a single request, using MGET and MSET.
+
+Requests go over persistent HTTP/1.1 connections kept in a small pool, so after
+the first request each one costs a single round trip rather than a new TCP (and
+TLS) handshake. A kept connection the server has since closed is replaced and
+the request sent again once.
 
 """
 
 
 # Import URL library
-import urllib.request, urllib.error, urllib.parse
+import urllib.error, urllib.parse
 from urllib.parse import quote as enc
+import http.client, threading, json
 
 class IMServerProxy:
 
-  def __init__(self, url):
+  def __init__(self, url, connections=4, timeout=10):
     self.url = url
+    parts = urllib.parse.urlsplit(url)
+    self.host = parts.netloc
+    self.path = parts.path or '/'
+    if parts.scheme == 'https':
+      self.connection_class = http.client.HTTPSConnection
+    else:
+      self.connection_class = http.client.HTTPConnection
+
+    # Seconds to wait on the server, and most idle connections kept open
+    self.timeout = timeout
+    self.connections = connections
+
+    self.idle = []
+    self.lock = threading.Lock()
 
   def __getitem__(self, key):
-    return urllib.request.urlopen('%s?action=get&key=%s'%(self.url, enc(key))).read()
+    return self.request('action=get&key=%s'%(enc(key)))
 
   def __setitem__(self, key, value):
-    urllib.request.urlopen('%s?action=set&key=%s&value=%s'%(self.url, enc(key), enc(value)))
+    self.request('action=set&key=%s&value=%s'%(enc(key), enc(value)))
 
   def __delitem__(self, key):
-    urllib.request.urlopen('%s?action=unset&key=%s'%(self.url, enc(key)))
+    self.request('action=unset&key=%s'%(enc(key)))
+
+  def get_many(self, keys):
+    # Values for every key in one request, in the same order
+    query = ''.join('&key%%5B%%5D=%s'%(enc(key)) for key in keys)
+    return [value.encode() for value in json.loads(self.request('action=mget' + query))]
+
+  def set_many(self, items):
+    # Set every key in a dict, or list of (key, value) pairs, in one request
+    if isinstance(items, dict):
+      items = items.items()
+    query = ''.join('&key%%5B%%5D=%s&value%%5B%%5D=%s'%(enc(key), enc(value)) for (key, value) in items)
+    self.request('action=mset' + query)
 
   def clear(self):
-    urllib.request.urlopen('%s?action=clear'%(self.url))
+    self.request('action=clear')
 
   def keys(self):
-    return urllib.request.urlopen('%s?action=keys'%(self.url)).read().splitlines()
+    return self.request('action=keys').splitlines()
+
+  def request(self, query):
+    # Send one request and return the body of the response
+    for attempt in range(2):
+      (connection, reused) = self.take()
+      try:
+        connection.request('GET', self.path + '?' + query)
+        response = connection.getresponse()
+        body = response.read()
+      except TimeoutError:
+        connection.close()
+        raise
+      except (http.client.HTTPException, OSError):
+        connection.close()
+        # The server may have closed a kept connection, try a new one
+        if reused and attempt == 0:
+          continue
+        raise
+
+      if response.will_close:
+        connection.close()
+      else:
+        self.give(connection)
+
+      if response.status >= 400:
+        raise urllib.error.HTTPError(self.url, response.status, response.reason, response.headers, None)
+      return body
+
+  def take(self):
+    # An idle connection, or a new one. Returns (connection, reused)
+    with self.lock:
+      if self.idle:
+        return (self.idle.pop(), True)
+    return (self.connection_class(self.host, timeout=self.timeout), False)
+
+  def give(self, connection):
+    with self.lock:
+      if len(self.idle) < self.connections:
+        self.idle.append(connection)
+        return
+    connection.close()
+
+  def close(self):
+    # Close every idle connection, new ones are opened as needed
+    with self.lock:
+      (idle, self.idle) = (self.idle, [])
+    for connection in idle:
+      connection.close()
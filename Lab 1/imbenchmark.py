@@ -0,0 +1,48 @@
+"""
+
+Microbenchmark for IMServerProxy against the local stand-in server: the time
+per get and set with the pooled keep-alive connections, against opening a new
+connection for every request as urllib.request.urlopen does.
+
+Run with: python imbenchmark.py [operations]
+
+"""
+
+import sys, time, threading, urllib.request
+from urllib.parse import quote as enc
+import im, imlocal
+
+def unpooled(url, count):
+  # One urlopen per request, each on a new connection
+  for i in range(count):
+    urllib.request.urlopen('%s?action=set&key=%s&value=%s'%(url, enc('key%d' % (i % 10)), enc('value'))).read()
+    urllib.request.urlopen('%s?action=get&key=%s'%(url, enc('key%d' % (i % 10)))).read()
+
+def pooled(url, count):
+  server = im.IMServerProxy(url)
+  for i in range(count):
+    server['key%d' % (i % 10)] = 'value'
+    server['key%d' % (i % 10)]
+  server.close()
+
+def measure(name, run, url, count):
+  run(url, 10)
+  start = time.perf_counter()
+  run(url, count)
+  elapsed = time.perf_counter() - start
+  print('%-10s %8.1f us per operation (%d operations)' % (name, elapsed / (count * 2) * 1e6, count * 2))
+  return elapsed
+
+if __name__ == '__main__':
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+  server = imlocal.IMLocalServer(('127.0.0.1', 0))
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  url = 'http://127.0.0.1:%d/IMserver.php' % server.server_address[1]
+
+  before = measure('urlopen', unpooled, url, count)
+  after = measure('pooled', pooled, url, count)
+  print('%.1fx faster' % (before / after))
+
+  server.shutdown()
+  server.server_close()
@@ -36,6 +36,10 @@
 #
 # If both clients disconnect, ther server will be reset when the next client
 # instance is started up.
+#
+# The server's URL can be given as an argument, for example to use the local
+# stand-in server in imlocal.py:
+#     python imclient_g75342ms.py http://localhost:8080/IMserver.php
 
 # ================================== CODE ======================================
 
@@ -44,15 +48,17 @@
 # Atexit - Exiting the program cleanly
 import im, time, sys, atexit
 
+SERVER_URL = 'https://web.cs.manchester.ac.uk/g75342ms/comp28112_ex1/IMserver.php'
+
 # Because the functionality of the server is limited to reading and writing
 # key/value pairs, processing needs to be done in each of the clients. These
 # features have been seperated out from the client component into a local
 # interface. In practice, this functionality would probably be provided on and
 # by the server itself.
 class LocalServerInterface:
-    def __init__(self):
-        # Init server connection
-        self.server = im.IMServerProxy('https://web.cs.manchester.ac.uk/g75342ms/comp28112_ex1/IMserver.php')
+    def __init__(self, url=SERVER_URL):
+        # Init server connection, kept open between requests
+        self.server = im.IMServerProxy(url)
         self.tag = "SERVER"
 
         # Assume our client is 'second in line' for setup
@@ -67,13 +73,6 @@ class LocalServerInterface:
             # Clear all existing KV pairs
             self.server.clear()
 
-            # Maximum connections allowed - unused currently but added so that
-            # there is theoretical possibility for expansion to >2 connections
-            self.server['CONNECTION_LIMIT'] = '2'
-            # Keeps track of the number of clients currently connected to the
-            # server
-            self.server['connections'] = '0'
-
             # If two clients attempt to setup at the same time without the
             # following, both clients will think they are connection 1 and will
             # deadlock waiting for the other client to connect.
@@ -85,32 +84,48 @@ class LocalServerInterface:
             # down until the first client sets can_setup to TRUE and releases
             # the second client.
             self.first_time_can_setup = True
-            self.server['can_setup'] = 'FALSE'
-
-            # Clients keeps a track of the names of the clients currently
-            # connected. Sender keeps track of which client is currently sending
-            # a message
-            self.server['clients'] = ''
-            self.server['sender'] = ''
-
-            # Used for notifiying the currenty recipient in the case where the
-            # sender disconnects, informing them to wait for another client
-            self.server['sender_disconnect'] = 'FALSE'
-
-            # Used for passing the messages between the clients. The sender
-            # writes to this key, and the recipient reads from it.
-            self.server['last_message'] = ''
 
-            # Can be:
-            #   - OPEN - Accepting new connections
-            #   - ACTIVE - Currently messaging, not accepting connections
-            #   - CLOSED - Messaging closed, no longer accepting connections
-            self.server['global_status'] = 'OPEN'
-
-            # Updated when the server is reset, helpful for debugging resets.
-            self.server['last_reset_timestamp'] = time.strftime("%H:%M:%S")
+            # Every key is written in a single request
+            last_reset_timestamp = time.strftime("%H:%M:%S")
+            self.server.set_many([
+                # Maximum connections allowed - unused currently but added so
+                # that there is theoretical possibility for expansion to >2
+                # connections
+                ('CONNECTION_LIMIT', '2'),
+                # Keeps track of the number of clients currently connected to
+                # the server
+                ('connections', '0'),
+                ('can_setup', 'FALSE'),
+
+                # Clients keeps a track of the names of the clients currently
+                # connected. Sender keeps track of which client is currently
+                # sending a message
+                ('clients', ''),
+                ('sender', ''),
+
+                # Used for notifiying the currenty recipient in the case where
+                # the sender disconnects, informing them to wait for another
+                # client
+                ('sender_disconnect', 'FALSE'),
+
+                # Used for passing the messages between the clients. The sender
+                # writes to this key, and the recipient reads from it.
+                ('last_message', ''),
+
+                # Can be:
+                #   - OPEN - Accepting new connections
+                #   - ACTIVE - Currently messaging, not accepting connections
+                #   - CLOSED - Messaging closed, no longer accepting connections
+                ('global_status', 'OPEN'),
+
+                # Updated when the server is reset, helpful for debugging
+                # resets.
+                ('last_reset_timestamp', last_reset_timestamp),
+            ])
+        else:
+            last_reset_timestamp = str(self.server['last_reset_timestamp'])[2:-1]
 
-        print("[" + self.tag + "] Server running, last reset at", str(self.server['last_reset_timestamp'])[2:-1])
+        print("[" + self.tag + "] Server running, last reset at", last_reset_timestamp)
 
     # Initial connection processing
     def connect(self):
@@ -176,32 +191,37 @@ class LocalServerInterface:
     def messaging(self):
         while True:
             # While 'we' are not the sender or we are the only connection to the
-            # server, wait.
-            while str(self.server['sender'])[2:-1] != self.client.name or int(str(self.server['connections'])[2:-1]) == 1:
-                time.sleep(1)
+            # server, wait. Each check reads every flag it needs in one request
+            while True:
+                (sender, connections, sender_disconnect) = [str(value)[2:-1] for value in self.server.get_many(['sender', 'connections', 'sender_disconnect'])]
 
                 # The recipient can read the sender_disconnect key to let them
                 # know if the sender has disconnected while the they are waiting
                 # waiting for their turn.
-                if str(self.server['sender_disconnect'])[2:-1] == 'TRUE':
+                if sender_disconnect == 'TRUE':
                     print("[" + self.tag + "] User '" + recipient + "' disconnected.")
                     print("[" + self.tag + "] Please wait for another connection or CTRL+C to exit.")
                     self.server['sender_disconnect'] = 'FALSE'
 
+                if sender == self.client.name and int(connections) != 1:
+                    break
+                time.sleep(1)
+
             # Identify the name of the recipient from the server's list of
             # clients
-            clients = str(self.server['clients'])[2:-1].split(',')
+            (clients, last_message) = self.server.get_many(['clients', 'last_message'])
+            clients = str(clients)[2:-1].split(',')
             clients.remove(self.client.name)
             recipient = clients[0]
 
             # If the last message is blank that means we are about to send the
             # first message in the chat so we notify the sender. Otherwise we
             # read the last_message key and display it to the client
-            if len(self.server['last_message']) == 0:
+            if len(last_message) == 0:
                 print("\n[" + self.tag + "] User '" + recipient + "' has connected, you are now chatting: ")
                 print(("=" * 34) + " CHAT " + ("=" * 34))
             else:
-                print(str(self.server['last_message'])[2:-1])
+                print(str(last_message)[2:-1])
 
             # Get the sender client's message
             self.client.get_message()
@@ -214,8 +234,7 @@ class LocalServerInterface:
                 print("[" + self.tag + "] User '" + recipient + "' disconnected, your message was not sent.")
                 print("[" + self.tag + "] Please wait for another connection or CTRL+C to exit.")
             else:
-                self.server['last_message'] = self.client.message_out
-                self.server['sender'] = recipient
+                self.server.set_many([('last_message', self.client.message_out), ('sender', recipient)])
 
     # Called when a client force disconnects with CTRL+C
     # Allows the server to accept new connections to the server without having
@@ -287,6 +306,6 @@ class Client:
 
 # Initialise the server interface which will then handle creating the client and
 # establshing a connection to the server.
-LSI = LocalServerInterface()
+LSI = LocalServerInterface(sys.argv[1] if len(sys.argv) > 1 else SERVER_URL)
 LSI.reset()
 LSI.connect()
@@ -0,0 +1,80 @@
+"""
+
+Local stand-in for IMServer.php, for trying the client and proxy without the
+university server. Keeps the dictionary in memory and answers the same
+requests: set, get, unset, keys, clear, mget and mset. Connections are kept alive between
+requests, as a real web server would.
+
+Run with: python imlocal.py [port]
+and point the client at http://localhost:<port>/IMserver.php
+
+"""
+
+import sys, json, threading, urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class IMLocalServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address):
+    ThreadingHTTPServer.__init__(self, address, IMRequestHandler)
+    self.data = {}
+    self.lock = threading.Lock()
+
+class IMRequestHandler(BaseHTTPRequestHandler):
+  # Keep-alive needs HTTP/1.1 and a Content-Length on every response
+  protocol_version = 'HTTP/1.1'
+
+  # Headers and body go out in separate writes, which Nagle's algorithm would
+  # hold up waiting for an ACK on a kept connection
+  disable_nagle_algorithm = True
+
+  def do_GET(self):
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query, keep_blank_values=True)
+    action = query.get('action', [''])[0]
+    key = query.get('key', [''])[0]
+    value = query.get('value', [''])[0]
+    keys = query.get('key[]', [])
+    values = query.get('value[]', [])
+    data = self.server.data
+    body = ''
+
+    with self.server.lock:
+      if action == 'get':
+        body = data.get(key, '')
+      elif action == 'set':
+        data[key] = value
+      elif action == 'mget':
+        body = json.dumps([data.get(key, '') for key in keys])
+      elif action == 'mset':
+        for (i, key) in enumerate(keys):
+          data[key] = values[i] if i < len(values) else ''
+      elif action == 'unset':
+        data.pop(key, None)
+      elif action == 'keys':
+        body = ''.join(key + '\n' for key in data)
+      elif action == 'clear':
+        data.clear()
+      else:
+        body = '<html><body><h1>COMP28112 Server: Messaging System for Healthcare Professionals</h1></body></html>'
+
+    body = body.encode()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/html; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    # Every key access would be logged otherwise
+    pass
+
+if __name__ == '__main__':
+  port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+  server = IMLocalServer(('127.0.0.1', port))
+  print('Serving on http://127.0.0.1:%d/IMserver.php' % port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
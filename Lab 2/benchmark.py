@@ -0,0 +1,438 @@
+"""
+Benchmarks for myserver.py.
+
+Each scenario starts its own copy of the server on a local port and drives it
+with simulated clients over raw sockets, so it can be pointed at older
+versions of the server (--server) to compare results:
+
+    python benchmark.py contention --pairs 8 --duration 5
+    python benchmark.py load --clients 200 --rate 2000 --mix broadcast=1,whisper=8,users=1
+    python benchmark.py fanout --clients 300 --rate 200
+    python benchmark.py dispatch
+
+Results are printed as a single JSON object.
+"""
+
+import sys, os, time, socket, selectors, threading, subprocess, tempfile, argparse, json, random
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The server script run by startServer(), changed with --server
+SERVER = os.path.join(HERE, "myserver.py")
+
+
+def listening(port):
+    """
+    True if a socket is listening on the local port. Read from the kernel's
+    socket tables rather than by connecting, as older servers take any
+    connection for a user and can stall waiting for it to send a name.
+    """
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(table) as sockets:
+                next(sockets)
+                for line in sockets:
+                    # Local address is hex ip:port, state 0A is LISTEN
+                    fields = line.split()
+                    if fields[3] == "0A" and int(fields[1].rpartition(":")[2], 16) == port:
+                        return True
+        except OSError:
+            pass
+    return False
+
+
+def startServer(port, server_args=()):
+    # Anything already on the port would answer in place of the server
+    # started here, and with --workers could even share the port with it
+    if listening(port):
+        raise RuntimeError("Something is already listening on port " + str(port))
+
+    # Start a server and wait until it accepts connections. Its errors are
+    # kept in a file rather than a pipe, which it could fill and block on
+    errors = tempfile.TemporaryFile()
+    process = subprocess.Popen([sys.executable, SERVER, "127.0.0.1", str(port)] + list(server_args),
+                               stdout=subprocess.DEVNULL, stderr=errors)
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        # Exited, such as when the port is in use. Whatever is listening
+        # there is not the server we started
+        if process.poll() != None:
+            errors.seek(0)
+            raise RuntimeError("Server exited with code " + str(process.returncode) + ":\n" + errors.read().decode(errors="replace"))
+
+        if listening(port):
+            return process
+        time.sleep(0.05)
+
+    stopServer(process)
+    raise RuntimeError("Server did not start on port " + str(port))
+
+
+def stopServer(process):
+    # SIGTERM first, so a server with --workers takes its workers with it
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class BenchClient:
+    """A simulated chat user talking the line protocol over a raw socket."""
+
+    def __init__(self, port, name, timeout=10):
+        self.name = name
+        self.socket = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+        self.buffer = b""
+
+        # Register the name and wait for the hidden acknowledgement, which
+        # carries a session token when the server keeps sessions
+        self.send(name)
+        while True:
+            line = self.readLine()
+            if line == "100" or line.startswith("100 "):
+                break
+
+    def send(self, line):
+        self.socket.sendall(line.encode() + b"\n")
+
+    def readLine(self):
+        while b"\n" not in self.buffer:
+            chunk = self.socket.recv(65536)
+            if not chunk:
+                raise ConnectionError(self.name + " was disconnected")
+            self.buffer += chunk
+
+        (line, _, self.buffer) = self.buffer.partition(b"\n")
+        return line.decode().strip()
+
+    def close(self):
+        self.socket.close()
+
+
+def processTree(pid):
+    """The pid given and all of its descendants, so --workers servers are measured whole."""
+    pids = [pid]
+    for pid in pids:
+        try:
+            for task in os.listdir("/proc/%d/task" % pid):
+                with open("/proc/%d/task/%s/children" % (pid, task)) as children:
+                    pids += [int(child) for child in children.read().split()]
+        except OSError:
+            pass
+    return pids
+
+
+def usage(pid):
+    """Resident memory in KB and CPU seconds used by a server and its workers."""
+    rss = 0
+    cpu = 0.0
+    ticks = os.sysconf("SC_CLK_TCK")
+    for pid in processTree(pid):
+        try:
+            with open("/proc/%d/status" % pid) as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1])
+            with open("/proc/%d/stat" % pid) as stat:
+                # Fields after the command name, which may itself hold spaces
+                fields = stat.read().rpartition(")")[2].split()
+                cpu += (int(fields[11]) + int(fields[12])) / ticks
+        except OSError:
+            pass
+    return (rss, cpu)
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+
+    def at(fraction):
+        return round(samples[int(fraction * (len(samples) - 1))] * 1000, 3)
+
+    return {"count": len(samples), "p50_ms": at(0.5), "p99_ms": at(0.99), "p999_ms": at(0.999), "max_ms": at(1)}
+
+
+def contention(port, pairs, duration, server_args=()):
+    """
+    Whisper throughput between independent pairs of users while one user
+    floods private messages at a client that has stopped reading.
+
+    With a single lock around every handler the flooder ends up blocked in a
+    send to the stalled client while holding that lock, and every other
+    conversation stops with it.
+    """
+    server = startServer(port, server_args)
+    try:
+        # Everyone registers first, join notices are broadcast to all
+        stalled = BenchClient(port, "stalled")
+        flooder = BenchClient(port, "flooder", timeout=None)
+        conversations = [(BenchClient(port, "a" + str(index)), BenchClient(port, "b" + str(index))) for index in range(pairs)]
+        stop = threading.Event()
+
+        def flood():
+            line = ("/whisper stalled " + "x" * 1000).encode() + b"\n"
+            try:
+                while not stop.is_set():
+                    flooder.socket.sendall(line)
+            except OSError:
+                pass
+
+        counts = [0] * pairs
+
+        def converse(index):
+            # Whisper back and forth so each side reads everything sent to it
+            (a, b) = conversations[index]
+            end = time.time() + duration
+            try:
+                while time.time() < end:
+                    a.send("/whisper " + b.name + " ping")
+                    while not b.readLine().startswith("[PRIVATE"):
+                        pass
+                    (a, b) = (b, a)
+                    counts[index] += 1
+            except OSError:
+                # Timed out waiting on a stalled server
+                pass
+
+        # Give the stalled client's socket buffers time to fill
+        threading.Thread(target=flood, daemon=True).start()
+        time.sleep(1)
+
+        workers = [threading.Thread(target=converse, args=(index,), daemon=True) for index in range(pairs)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        stop.set()
+
+        return {"scenario": "contention", "pairs": pairs, "duration_s": duration,
+                "whispers": sum(counts), "whispers_per_s": round(sum(counts) / duration, 1)}
+    finally:
+        stopServer(server)
+        server.wait()
+
+
+def load(port, clients, rate, mix, duration, server_args=()):
+    """
+    A crowd of users sending a mix of broadcasts, whispers and /users at a
+    fixed overall rate.
+
+    Each broadcast and whisper carries the time it was sent, so every copy
+    delivered gives a fan-out latency, and /users is timed from request to
+    reply. Server memory is measured before and after everyone connects, and
+    its CPU time over the measured period.
+    """
+    server = startServer(port, server_args)
+    try:
+        (baseRss, _) = usage(server.pid)
+        users = [BenchClient(port, "u" + str(index), timeout=30) for index in range(clients)]
+        (connectedRss, _) = usage(server.pid)
+
+        # One thread reads for everyone, so the clients cost little of the CPU
+        # the server is being measured on
+        selector = selectors.DefaultSelector()
+        for user in users:
+            user.socket.setblocking(False)
+            user.asking = []
+            selector.register(user.socket, selectors.EVENT_READ, user)
+
+        latencies = {"broadcast": [], "whisper": [], "users": []}
+        delivered = [0]
+        stop = threading.Event()
+
+        def receive(user, line):
+            now = time.monotonic()
+            if line.startswith("[SERVER] Connected users:"):
+                if user.asking:
+                    latencies["users"].append(now - user.asking.pop(0))
+                return
+
+            (tag, _, body) = line.partition("] ")
+            if not body.startswith("@"):
+                return
+            kind = "whisper" if tag.startswith("[PRIVATE") else "broadcast"
+            latencies[kind].append(now - float(body[1:]))
+            delivered[0] += 1
+
+        def read():
+            while not stop.is_set():
+                for (key, mask) in selector.select(0.1):
+                    user = key.data
+                    try:
+                        chunk = user.socket.recv(65536)
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        chunk = b""
+                    if not chunk:
+                        selector.unregister(user.socket)
+                        continue
+
+                    user.buffer += chunk
+                    (*lines, user.buffer) = user.buffer.split(b"\n")
+                    for line in lines:
+                        receive(user, line.decode(errors="replace").strip())
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+
+        kinds = [kind for (kind, weight) in mix.items() for count in range(weight)]
+        sent = {kind: 0 for kind in mix}
+        (_, startCpu) = usage(server.pid)
+        start = time.monotonic()
+        end = start + duration
+        due = start
+
+        while True:
+            # Sent on a fixed schedule, so a slow server shows up as latency
+            # rather than as fewer messages being sent
+            now = time.monotonic()
+            if now >= end:
+                break
+            if due > now:
+                time.sleep(due - now)
+            due += 1 / rate
+
+            user = random.choice(users)
+            kind = random.choice(kinds)
+            if kind == "broadcast":
+                line = "@%r" % time.monotonic()
+            elif kind == "whisper":
+                line = "/whisper %s @%r" % (random.choice(users).name, time.monotonic())
+            else:
+                user.asking.append(time.monotonic())
+                line = "/users"
+
+            try:
+                user.socket.sendall(line.encode() + b"\n")
+            except BlockingIOError:
+                # The server has stopped reading from this user
+                continue
+            sent[kind] += 1
+
+        elapsed = time.monotonic() - start
+        (_, endCpu) = usage(server.pid)
+
+        # Let the last messages arrive before counting them
+        time.sleep(min(2, duration))
+        stop.set()
+        reader.join()
+        for user in users:
+            user.close()
+
+        total = sum(sent.values())
+        return {"scenario": "load", "clients": clients, "rate": rate, "mix": mix, "duration_s": duration,
+                "server_args": list(server_args),
+                "sent": sent, "sent_per_s": round(total / elapsed, 1),
+                "delivered": delivered[0], "delivered_per_s": round(delivered[0] / elapsed, 1),
+                "latency": {kind: percentiles(samples) for (kind, samples) in latencies.items()},
+                "rss_kb": connectedRss, "rss_kb_per_connection": round((connectedRss - baseRss) / clients, 2),
+                "cpu_s": round(endCpu - startCpu, 3),
+                "cpu_us_per_message": round((endCpu - startCpu) / max(total, 1) * 1e6, 1),
+                "cpu_us_per_delivery": round((endCpu - startCpu) / max(delivered[0], 1) * 1e6, 1)}
+    finally:
+        stopServer(server)
+        server.wait()
+
+
+def fanout(port, clients, rate, duration, server_args=()):
+    """
+    Broadcasts only, so the server's CPU time per delivery is what each
+    broadcast costs per recipient.
+    """
+    result = load(port, clients, rate, {"broadcast": 1}, duration, server_args)
+    result["scenario"] = "fanout"
+    result["cpu_us_per_recipient"] = result.pop("cpu_us_per_delivery")
+    return result
+
+
+def dispatch(iterations, sizes=(10, 100, 1000, 10000)):
+    """
+    Time to find and run a command as more commands are installed, against
+    the if chain of string comparisons processCommand used to be. Runs in
+    process, no server is started. The command looked up is the last one
+    installed, the worst case for the chain.
+    """
+    from commands import CommandTable
+
+    line = "/whisper bob hello there"
+
+    def handler(server, socket, args):
+        pass
+
+    results = []
+    for size in sizes:
+        table = CommandTable()
+        for index in range(size - 1):
+            table.command("command" + str(index))(handler)
+        table.command("whisper", split=1, minimum=2)(handler)
+
+        def lookup():
+            (name, command, args) = table.parse(line)
+            command.handler(None, None, args)
+
+        names = [command.name for command in table]
+
+        def chain():
+            words = line.strip().split(' ')
+            command = words[0][1:].lower()
+            for name in names:
+                if command == name:
+                    handler(None, None, [words[1], ' '.join(words[2:])])
+                    break
+
+        timings = {}
+        for (label, function) in (("table", lookup), ("if_chain", chain)):
+            # The chain gets slow, so time fewer of those when it is long
+            count = max(iterations * 10 // size, 1000) if label == "if_chain" else iterations
+            start = time.perf_counter()
+            for index in range(count):
+                function()
+            timings[label + "_ns"] = round((time.perf_counter() - start) / count * 1e9, 1)
+
+        results.append(dict(commands=size, **timings))
+
+    return {"scenario": "dispatch", "iterations": iterations, "results": results}
+
+
+def parseMix(text):
+    # "broadcast=1,whisper=8" -> {"broadcast": 1, "whisper": 8}
+    mix = {}
+    for part in text.split(","):
+        (kind, _, weight) = part.partition("=")
+        if kind not in ("broadcast", "whisper", "users"):
+            raise argparse.ArgumentTypeError("unknown message kind " + repr(kind))
+        mix[kind] = int(weight or 1)
+    return mix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for myserver.py")
+    parser.add_argument("scenario", choices=["contention", "load", "fanout", "dispatch"])
+    parser.add_argument("--port", type=int, default=9500)
+    parser.add_argument("--server", default=SERVER, help="server script to run, to compare against another version")
+    parser.add_argument("--pairs", type=int, default=8, help="contention: number of pairs of users whispering to each other")
+    parser.add_argument("--clients", type=int, default=100, help="load, fanout: number of users connected")
+    parser.add_argument("--rate", type=float, default=1000, help="load, fanout: messages sent per second, across all users")
+    parser.add_argument("--mix", type=parseMix, default="broadcast=1,whisper=8,users=1",
+                        help="load: relative weights of broadcast, whisper and users messages")
+    parser.add_argument("--iterations", type=int, default=200000, help="dispatch: commands looked up per measurement")
+    parser.add_argument("--duration", type=float, default=5, help="seconds to measure for")
+    parser.add_argument("--server-arg", action="append", default=[], help="extra argument passed to the server")
+    args = parser.parse_args()
+
+    SERVER = os.path.abspath(args.server)
+    if args.scenario == "contention":
+        result = contention(args.port, args.pairs, args.duration, args.server_arg)
+    elif args.scenario == "dispatch":
+        result = dispatch(args.iterations)
+    elif args.scenario == "fanout":
+        result = fanout(args.port, args.clients, args.rate, args.duration, args.server_arg)
+    else:
+        result = load(args.port, args.clients, args.rate, args.mix, args.duration, args.server_arg)
+    print(json.dumps(result))
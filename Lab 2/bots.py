@@ -0,0 +1,354 @@
+"""
+Headless clients for myserver.py, for relays, bridges and other programs
+that talk to the server without anyone typing.
+
+A BotPool holds any number of bots, each one user on the server, and
+receives for all of them on one thread with a selector rather than a thread
+each. Connecting happens on that thread too, so nothing blocks the caller.
+Anything that waits on the server returns a concurrent.futures.Future,
+which can be waited on with result(), given a callback with
+add_done_callback(), or awaited from asyncio through asyncio.wrap_future().
+The hidden codes the server sends (100, 200, 400 and the presence feed) are
+dealt with here and never reach the bot's messages.
+
+    pool = BotPool("127.0.0.1", 8090)
+    bot = pool.connect("alerts").result()
+    bot.say("Disk space low on web1")
+    bot.whisper("admin", "Details in the log")
+    print(bot.users().result())
+    for message in bot.messages():
+        ...
+    pool.stop()
+"""
+
+import os, time, errno, queue, threading, selectors, collections, socket as socketlib
+from concurrent import futures
+from concurrent.futures import Future
+from ex2utils import Client, Receiver
+
+
+class BotError(Exception):
+    """The server turned a bot's name down, or it lost its connection first."""
+
+
+class Bot(Client):
+    """
+    One user on the server, made by BotPool.connect().
+
+    Messages are passed to onMessage(bot, message) on the pool's thread if
+    it was given, otherwise they are queued for messages(), with no limit
+    on how many wait there.
+    """
+
+    def __init__(self, pool, onMessage=None):
+        Receiver.__init__(self)
+        self.pool = pool
+        self.callback = onMessage
+
+        self.name = ""
+        self.accepted = False
+
+        # The socket while the pool's thread connects it, and set once it
+        # has connected
+        self.connecting = None
+        self.started = False
+
+        # Set once the name has been sent, what the server says before that
+        # is only its greeting
+        self.naming = False
+
+        # Channel plain messages go to, None for everyone
+        self.channel = None
+
+        # Everyone connected (folded name -> name) from the presence feed,
+        # None until the full list arrives, and users() waiting for it
+        self.roster = None
+        self.presenceVersion = None
+        self.rosterWaiting = []
+
+        # Answered when the name is accepted or turned down, and once the
+        # connection has closed
+        self.named = Future()
+        self.closed = Future()
+
+        # Messages for messages(), None marks the end
+        self.inbox = queue.Queue()
+
+    # Called from any thread
+
+    def say(self, text):
+        """Send a message to everyone."""
+        self.send(("/all " + text).encode())
+
+    def whisper(self, user, text):
+        self.send(("/whisper " + user + " " + text).encode())
+
+    def command(self, line):
+        """Send any line as it is, such as '/join room'."""
+        self.send(line.encode())
+
+    def users(self):
+        """A Future of everyone's names, from the bot's own list so no request is sent."""
+        future = Future()
+        with self._lock:
+            if self.roster != None:
+                future.set_result(sorted(self.roster.values()))
+            else:
+                self.rosterWaiting.append(future)
+        return future
+
+    def messages(self, timeout=None):
+        """
+        Every message for this bot as it arrives, until it disconnects.
+        Blocks waiting for each, raising queue.Empty after timeout seconds.
+        """
+        while True:
+            message = self.inbox.get(timeout=timeout)
+            if message == None:
+                return
+            yield message
+
+    def disconnect(self):
+        """Leave the server, returns a Future answered once the connection has closed."""
+        if self.started and not self.closed.done():
+            try:
+                self.send("/disconnect".encode())
+            except OSError:
+                pass
+        return self.closed
+
+    # Called on the pool's thread
+
+    def sendName(self):
+        # Once the server has answered the request for frames, or given up
+        # waiting for it
+        if not self.naming:
+            self.naming = True
+            self.pool.deadlines.pop(self, None)
+            self.send(self.name.encode())
+
+    def onFrames(self):
+        self.sendName()
+
+    def failed(self, error):
+        # Never got connected, so there is no connection to close
+        self.named.set_exception(error)
+        self.inbox.put(None)
+        self.pool.forget(self)
+        self.closed.set_result(None)
+
+    def onMessage(self, socket, message):
+        message = message.strip()
+
+        if not self.accepted:
+            if not self.naming:
+                return True
+            if message == "100" or message.startswith("100 "):
+                self.accepted = True
+                self.send("/presence".encode())
+                self.named.set_result(self)
+            elif not self.named.done():
+                # The only other answer to a name is why it was turned down
+                self.named.set_exception(BotError(message))
+                return False
+            return True
+
+        if message == "200":
+            return True
+
+        if message == "400" or message.startswith("400 "):
+            self.channel = message[4:] or None
+            return True
+
+        if message.startswith("500 ") or message.startswith("501 "):
+            self.presence(message)
+            return True
+
+        if self.callback != None:
+            self.callback(self, message)
+        else:
+            self.inbox.put(message)
+        return True
+
+    def presence(self, message):
+        # '500 <version> <names>' or '501 <version> +name/-name'
+        (code, _, rest) = message.partition(' ')
+        (version, _, change) = rest.partition(' ')
+        version = int(version)
+
+        with self._lock:
+            if code == "500":
+                self.roster = {name.casefold(): name for name in change.split(',') if name}
+                self.presenceVersion = version
+            elif self.presenceVersion == None or version <= self.presenceVersion:
+                return
+            elif version != self.presenceVersion + 1:
+                # Missed a change, ask for the whole list again
+                self.presenceVersion = None
+                self.send("/presence".encode())
+                return
+            else:
+                if change.startswith('+'):
+                    self.roster[change[1:].casefold()] = change[1:]
+                else:
+                    self.roster.pop(change[1:].casefold(), None)
+                self.presenceVersion = version
+
+            (waiting, self.rosterWaiting) = (self.rosterWaiting, [])
+            names = sorted(self.roster.values())
+
+        for future in waiting:
+            future.set_result(names)
+
+    def onDisconnect(self, socket):
+        if not self.named.done():
+            self.named.set_exception(BotError("Connection closed before the name was accepted"))
+        with self._lock:
+            (waiting, self.rosterWaiting) = (self.rosterWaiting, [])
+        for future in waiting:
+            future.set_exception(BotError("Connection closed"))
+        self.inbox.put(None)
+        self.pool.forget(self)
+        self.closed.set_result(None)
+
+
+class BotPool:
+    """Any number of bots connected to one server, connected and received for on a single thread."""
+
+    # Seconds to wait for a connection, and for the server to answer the
+    # request for frames before carrying on with lines
+    timeout = 5
+
+    def __init__(self, ip, port):
+        self.address = (ip, port)
+        self.lock = threading.Lock()
+        self.bots = set()
+
+        # Bots not yet handed to the pool's thread. Only that thread touches
+        # the selector, and the bots still connecting or waiting for frames
+        # (bot -> when to give up waiting)
+        self.pending = collections.deque()
+        self.deadlines = {}
+        (self.wakeReader, self.wakeWriter) = socketlib.socketpair()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.wakeReader, selectors.EVENT_READ)
+
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def connect(self, name, onMessage=None):
+        """
+        Connect a new bot as name, returns a Future of the Bot once the name
+        is accepted. Fails with BotError if it is turned down, or OSError if
+        the server cannot be reached. Returns straight away, the connecting
+        is done on the pool's thread.
+        """
+        bot = Bot(self, onMessage)
+        bot.name = name
+
+        with self.lock:
+            self.bots.add(bot)
+            self.pending.append(bot)
+        self.wake()
+        return bot.named
+
+    def stop(self):
+        """Disconnect every bot and stop the pool's thread."""
+        with self.lock:
+            bots = list(self.bots)
+        for bot in bots:
+            bot.disconnect()
+        futures.wait([bot.closed for bot in bots], 5)
+
+        self.stopped = True
+        self.wake()
+        self.thread.join()
+
+        # Whoever did not answer in time is cut off
+        for bot in bots:
+            if bot.closed.done():
+                continue
+            if bot.started:
+                bot.stop()
+            else:
+                bot.connecting.close()
+                bot.failed(BotError("The pool was stopped before the bot connected"))
+        self.selector.close()
+        self.wakeReader.close()
+        self.wakeWriter.close()
+
+    def forget(self, bot):
+        with self.lock:
+            self.bots.discard(bot)
+
+    def wake(self):
+        try:
+            self.wakeWriter.send(b'\0')
+        except OSError:
+            pass
+
+    def run(self):
+        while not self.stopped:
+            timeout = None
+            if self.deadlines:
+                timeout = max(min(self.deadlines.values()) - time.monotonic(), 0)
+
+            for (key, mask) in self.selector.select(timeout):
+                if key.fileobj is self.wakeReader:
+                    self.wakeReader.recv(4096)
+                    while self.pending:
+                        self.begin(self.pending.popleft())
+                elif key.data != None:
+                    self.connected(key.data)
+                elif not key.fileobj.receive():
+                    self.selector.unregister(key.fileobj)
+                    self.deadlines.pop(key.fileobj, None)
+
+            now = time.monotonic()
+            for (bot, deadline) in list(self.deadlines.items()):
+                if deadline <= now:
+                    self.expired(bot)
+
+    def begin(self, bot):
+        # Start connecting without waiting, the socket is writable once done
+        bot.connecting = socketlib.socket(socketlib.AF_INET, socketlib.SOCK_STREAM)
+        bot.connecting.setblocking(False)
+        error = bot.connecting.connect_ex(self.address)
+        if error != 0 and error != errno.EINPROGRESS:
+            bot.connecting.close()
+            bot.failed(OSError(error, os.strerror(error)))
+            return
+
+        self.selector.register(bot.connecting, selectors.EVENT_WRITE, bot)
+        self.deadlines[bot] = time.monotonic() + self.timeout
+
+    def connected(self, bot):
+        self.selector.unregister(bot.connecting)
+        error = bot.connecting.getsockopt(socketlib.SOL_SOCKET, socketlib.SO_ERROR)
+        if error != 0:
+            del self.deadlines[bot]
+            bot.connecting.close()
+            bot.failed(OSError(error, os.strerror(error)))
+            return
+
+        # Ask for frames, the name goes once the server has answered
+        bot.connecting.setblocking(True)
+        bot.started = True
+        bot.startOn(bot.connecting, frames=True, threaded=False)
+        self.selector.register(bot, selectors.EVENT_READ)
+        self.deadlines[bot] = time.monotonic() + self.timeout
+
+    def expired(self, bot):
+        del self.deadlines[bot]
+        if not bot.started:
+            self.selector.unregister(bot.connecting)
+            bot.connecting.close()
+            bot.failed(BotError("Timed out connecting to the server"))
+        else:
+            # The server did not answer the request for frames, carry on
+            # with lines
+            bot.sendName()
+
+    def __len__(self):
+        return len(self.bots)
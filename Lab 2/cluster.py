@@ -0,0 +1,389 @@
+"""
+Multi-process mode for myserver.py.
+
+Several worker processes each run their own copy of the server on the same
+port (SO_REUSEPORT), so the OS spreads connections between them and every
+worker gets a core and a GIL of its own. Whatever has to look like a single
+server - the names in use, broadcasts and private messages - goes through a
+hub in the parent process, which each worker talks to over a Unix-domain
+socket.
+
+Bus messages are newline delimited JSON objects with an "op" field:
+    claim   {id, name}            reply {others}, others is null if taken
+    release {name}
+    names   {id}                  reply {names, version}
+    all     {message, sender}     passed on to every other worker
+    channel {message, channel, sender}
+                                  passed on to every other worker, which
+                                  delivers to its members of the channel
+    user    {id, message, to}     passed on to the worker holding 'to',
+                                  reply {found}
+    presence {name, joined, version}
+                                  sent by the hub to every worker when a
+                                  name is claimed or released
+Replies have op "reply" and the id of the request they answer.
+
+The hub never blocks on a worker: what it has to send waits in a buffer per
+worker, written out as the worker reads. Workers shut down cleanly on
+SIGTERM, or once their connection to the hub closes, which is how the parent
+tells them to stop when it is sent SIGTERM itself.
+"""
+
+import os, json, signal, socket, selectors, tempfile, threading, itertools, multiprocessing
+from ex2utils import LineFramer
+from registry import Registry
+
+
+class Hub:
+    """Keeps the shared namespace, runs in the parent process."""
+
+    def __init__(self, path):
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(64)
+
+        # Worker connection -> framer for its partial input, and what is
+        # waiting to be sent to it
+        self.workers = {}
+        self.outputs = {}
+
+        # Folded name -> worker connection holding it, names compare the
+        # same way as in a worker's Registry
+        self.owners = {}
+
+        # Folded name -> the name as it was claimed
+        self.names = {}
+
+        # Presence version, one more for every name claimed or released
+        self.version = 0
+
+        # stop() may be called from a signal handler, it only sets the flag
+        # and wakes serve()
+        self.stopping = False
+        (self.wakeReader, self.wakeWriter) = socket.socketpair()
+        self.selector = selectors.DefaultSelector()
+
+    def serve(self, expected):
+        """Relay between workers until all expected workers have gone, or stop() is called."""
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.selector.register(self.wakeReader, selectors.EVENT_READ)
+        seen = 0
+
+        while (seen < expected or self.workers) and not self.stopping:
+            for (key, mask) in self.selector.select():
+                if key.fileobj is self.wakeReader:
+                    self.wakeReader.recv(4096)
+                    continue
+
+                if key.fileobj is self.listener:
+                    (worker, address) = self.listener.accept()
+                    worker.setblocking(False)
+                    self.workers[worker] = LineFramer(1 << 24)
+                    self.outputs[worker] = bytearray()
+                    self.selector.register(worker, selectors.EVENT_READ)
+                    seen += 1
+                    continue
+
+                worker = key.fileobj
+                if worker not in self.workers:
+                    # Forgotten earlier in this round
+                    continue
+                if mask & selectors.EVENT_READ:
+                    self.read(worker)
+                if mask & selectors.EVENT_WRITE and worker in self.workers:
+                    self.flush(worker)
+
+        # Closing the connections tells every worker left to shut down
+        for worker in list(self.workers):
+            self.forget(worker)
+        self.selector.close()
+
+    def stop(self):
+        self.stopping = True
+        try:
+            self.wakeWriter.send(b'\0')
+        except OSError:
+            pass
+
+    def read(self, worker):
+        try:
+            data = worker.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self.forget(worker)
+            return
+
+        for line in self.workers[worker].feed(data):
+            self.handle(worker, line)
+
+    def handle(self, worker, line):
+        request = json.loads(line)
+        op = request["op"]
+
+        if op == "claim":
+            name = Registry.key(request["name"])
+            if name in self.owners:
+                self.reply(worker, request, others=None)
+            else:
+                self.owners[name] = worker
+                self.names[name] = request["name"]
+                self.reply(worker, request, others=len(self.owners) - 1)
+                self.presence(request["name"], True)
+
+        elif op == "release":
+            name = Registry.key(request["name"])
+            if self.owners.get(name) is worker:
+                self.free(name)
+
+        elif op == "names":
+            self.reply(worker, request, names=list(self.names.values()), version=self.version)
+
+        elif op == "all" or op == "channel":
+            # Pass the line on untouched, each worker excludes the sender
+            data = (line + "\n").encode()
+            for other in list(self.workers):
+                if other is not worker:
+                    self.write(other, data)
+
+        elif op == "user":
+            owner = self.owners.get(Registry.key(request["to"]))
+            if owner != None:
+                self.write(owner, (line + "\n").encode())
+            self.reply(worker, request, found=owner != None)
+
+    def free(self, name):
+        del self.owners[name]
+        self.presence(self.names.pop(name), False)
+
+    def presence(self, name, joined):
+        # Every worker numbers its presence feed from here
+        self.version += 1
+        data = (json.dumps({"op": "presence", "name": name, "joined": joined, "version": self.version}) + "\n").encode()
+        for worker in list(self.workers):
+            self.write(worker, data)
+
+    def reply(self, worker, request, **values):
+        values["op"] = "reply"
+        values["id"] = request["id"]
+        self.write(worker, (json.dumps(values) + "\n").encode())
+
+    def write(self, worker, data):
+        # Queue behind anything not yet sent, or send now if nothing is
+        output = self.outputs[worker]
+        queued = len(output) > 0
+        output += data
+        if not queued:
+            self.flush(worker)
+
+    def flush(self, worker):
+        # Send as much as the worker will take without blocking, and wait to
+        # be told it can take more if that was not everything
+        output = self.outputs[worker]
+        try:
+            sent = worker.send(output)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            # Its disconnect will be seen when reading
+            sent = len(output)
+        del output[:sent]
+
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if output else 0)
+        if self.selector.get_key(worker).events != events:
+            self.selector.modify(worker, events)
+
+    def forget(self, worker):
+        # A worker has exited, free every name it held
+        self.selector.unregister(worker)
+        del self.workers[worker]
+        del self.outputs[worker]
+        for name in [name for (name, owner) in self.owners.items() if owner is worker]:
+            self.free(name)
+        worker.close()
+
+    def close(self):
+        self.listener.close()
+        self.wakeReader.close()
+        self.wakeWriter.close()
+
+
+class Bus:
+    """A worker's connection to the hub, used by EchoServer when set as its bus."""
+
+    # Seconds to wait for the hub before giving up on a request
+    timeout = 5
+
+    def __init__(self, path):
+        # Connect straight away so the hub knows about this worker even if it
+        # fails to start, anything sent before start() waits in the socket
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+
+        self.ids = itertools.count()
+
+        # One line is written at a time, so lines from different threads do
+        # not interleave
+        self.lock = threading.Lock()
+
+        # Request id -> [event, reply] for requests awaiting an answer. Its
+        # lock is never held while sending or receiving, so the thread
+        # receiving replies cannot be held up by one sending
+        self.waiting = {}
+        self.waitingLock = threading.Lock()
+
+        # Set once the hub has gone, requests are answered straight away with
+        # nothing, and when stop() has been called
+        self.closed = False
+        self.stopping = False
+
+    def start(self, server):
+        self.server = server
+        self.thread = threading.Thread(target=self.receive, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.thread.join()
+        self.socket.close()
+
+    def claim(self, name):
+        """Take a name for everyone, returns how many others are connected or None if taken."""
+        return self.request({"op": "claim", "name": name}).get("others")
+
+    def release(self, name):
+        self.post({"op": "release", "name": name})
+
+    def names(self):
+        return self.request({"op": "names"}).get("names", [])
+
+    def presence(self):
+        """(version, names) for everyone on every worker."""
+        reply = self.request({"op": "names"})
+        return (reply.get("version", 0), reply.get("names", []))
+
+    def broadcast(self, message, sender):
+        self.post({"op": "all", "message": message.decode(), "sender": sender})
+
+    def channel(self, message, channel, sender):
+        self.post({"op": "channel", "message": message.decode(), "channel": channel, "sender": sender})
+
+    def whisper(self, message, recipient):
+        """Deliver to a user on another worker, returns False if nobody has that name."""
+        return self.request({"op": "user", "message": message.decode(), "to": recipient}).get("found", False)
+
+    def post(self, request):
+        data = (json.dumps(request) + "\n").encode()
+        with self.lock:
+            try:
+                self.socket.sendall(data)
+            except OSError:
+                pass
+
+    def request(self, request):
+        request["id"] = next(self.ids)
+        slot = [threading.Event(), {}]
+        with self.waitingLock:
+            if self.closed:
+                return slot[1]
+            self.waiting[request["id"]] = slot
+
+        self.post(request)
+        slot[0].wait(self.timeout)
+
+        with self.waitingLock:
+            del self.waiting[request["id"]]
+        return slot[1]
+
+    def receive(self):
+        framer = LineFramer(1 << 24)
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                break
+
+            for line in framer.feed(data):
+                message = json.loads(line)
+                op = message["op"]
+
+                if op == "reply":
+                    with self.waitingLock:
+                        slot = self.waiting.get(message["id"])
+                    if slot != None:
+                        slot[1] = message
+                        slot[0].set()
+                elif op == "all":
+                    self.server.deliverToAll(message["message"].encode(), message["sender"])
+                elif op == "channel":
+                    self.server.deliverToChannel(message["message"].encode(), message["channel"], message["sender"])
+                elif op == "user":
+                    self.server.deliverToUser(message["message"].encode(), message["to"])
+                elif op == "presence":
+                    self.server.presence.publish(message["name"], message["joined"], message["version"])
+
+        # The hub has gone, nobody waiting will get an answer
+        with self.waitingLock:
+            self.closed = True
+            for slot in self.waiting.values():
+                slot[0].set()
+
+        # Without it names can no longer be shared, so unless the worker is
+        # already stopping this is the parent telling it to
+        if not self.stopping:
+            self.server.stop()
+
+
+def work(createServer, ip, port, path, eventLoop):
+    server = createServer()
+    server.reusePort = True
+    server.bus = Bus(path)
+
+    # Sent by the parent if it is still here after closing the bus
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    try:
+        server.start(ip, port, eventLoop=eventLoop)
+    except KeyboardInterrupt:
+        pass
+
+
+def serve(createServer, ip, port, workers, eventLoop=False):
+    """Run a number of servers made by createServer() on one port, sharing one set of users."""
+    directory = tempfile.mkdtemp(prefix="chat-")
+    path = os.path.join(directory, "hub.sock")
+    hub = Hub(path)
+
+    # The hub is listening before any worker starts, so they can connect at once
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=work, args=(createServer, ip, port, path, eventLoop)) for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    # Workers were forked without this, and handle SIGTERM themselves
+    signal.signal(signal.SIGTERM, lambda signum, frame: hub.stop())
+
+    try:
+        hub.serve(workers)
+    except KeyboardInterrupt:
+        # Workers get the interrupt too and shut themselves down
+        pass
+    finally:
+        # Each worker has up to 5 seconds to stop, then is asked again with
+        # SIGTERM, which also stops it cleanly
+        for process in processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+                process.join(5)
+        hub.close()
+        os.unlink(path)
+        os.rmdir(directory)
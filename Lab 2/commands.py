@@ -0,0 +1,88 @@
+"""
+Chat commands for myserver.py, looked up by name in a table.
+
+Commands are registered with a handler taking (server, socket, args) and
+returning False to disconnect the client. The built-in commands live on
+EchoServer, and more can be added from other modules with --plugin: the
+module is imported and its register(commands) function called with the
+server's CommandTable, for example
+
+    def register(commands):
+        @commands.command("roll", usage="roll <sides>", help="Roll a die", minimum=1, maximum=1)
+        def roll(server, socket, args):
+            ...
+"""
+
+
+class Command:
+    """
+    A command's handler and how its arguments are split.
+
+    With split=None the text after the command is split into words. With
+    split=n only the first n words are split off and the rest is passed on
+    as one argument, exactly as the user typed it. Lines with fewer than
+    minimum or more than maximum arguments get the usage text instead.
+    """
+
+    __slots__ = ("name", "handler", "usage", "help", "split", "minimum", "maximum")
+
+    def __init__(self, name, handler, usage=None, help="", split=None, minimum=0, maximum=None):
+        self.name = name
+        self.handler = handler
+        self.usage = usage or name
+        self.help = help
+        self.split = split
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def parse(self, text):
+        """The arguments in text, or None if there are the wrong number of them."""
+        if self.split == None:
+            args = text.split()
+        else:
+            args = text.split(None, self.split)
+
+        if len(args) < self.minimum or (self.maximum != None and len(args) > self.maximum):
+            return None
+        return args
+
+
+class CommandTable:
+    """Command name -> Command, finding a command takes the same time however many there are."""
+
+    def __init__(self):
+        self.commands = {}
+
+    def add(self, command):
+        self.commands[command.name] = command
+
+    def command(self, name, **options):
+        """Decorator registering a handler under name, see Command for the options."""
+        def register(handler):
+            self.add(Command(name, handler, **options))
+            return handler
+        return register
+
+    def get(self, name):
+        return self.commands.get(name)
+
+    def parse(self, line):
+        """
+        Split a '/command args' line once, returns (name, command, args).
+
+        command is None if there is no such command, and args is None if it
+        was given the wrong number of arguments.
+        """
+        (name, _, text) = line[1:].partition(' ')
+        name = name.lower()
+        command = self.commands.get(name)
+        if command == None:
+            return (name, None, None)
+        return (name, command, command.parse(text))
+
+    def __iter__(self):
+        # In the order they were registered
+        return iter(self.commands.values())
+
+    def __len__(self):
+        return len(self.commands)
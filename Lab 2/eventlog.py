@@ -0,0 +1,120 @@
+"""
+Structured logging for myserver.py that never holds up message handling.
+
+Records are an event name plus keyword fields. Logging one only appends it
+to a bounded in-memory ring; a background thread formats the records and
+writes them out. If the output cannot keep up the oldest records are
+overwritten, and the writer reports how many were lost.
+"""
+
+import sys, json, time, threading, itertools, collections
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+NAMES = {number: name.upper() for (name, number) in LEVELS.items()}
+
+
+class Logger:
+    """
+    Collects records from any thread and writes them from its own.
+
+    level is the least severe level kept. sample maps event names to N, to
+    keep only one in every N of those events. fields are added to every
+    record, such as the worker process it came from. Records are written as
+    text lines or, with format="json", one JSON object per line.
+    """
+
+    # Seconds between writes when records are waiting
+    interval = 0.1
+
+    def __init__(self, stream=None, level=INFO, sample=None, capacity=65536, format="text", fields=None):
+        self.stream = stream if stream != None else sys.stdout
+        self.level = level
+        self.format = format
+        self.fields = fields or {}
+        self.capacity = capacity
+
+        # Appending to a bounded deque is atomic and never blocks, once full
+        # the oldest record makes way for the newest
+        self.ring = collections.deque(maxlen=capacity)
+        self.overwritten = 0
+
+        # Event -> (N, counter), the counter only ever moves forwards
+        self.sampling = {event: (every, itertools.count()) for (event, every) in (sample or {}).items() if every > 1}
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def log(self, level, event, **fields):
+        if level < self.level:
+            return
+
+        if event in self.sampling:
+            (every, counter) = self.sampling[event]
+            if next(counter) % every:
+                return
+            fields["sampled"] = every
+
+        if len(self.ring) == self.capacity:
+            self.overwritten += 1
+        self.ring.append((time.time(), level, event, fields))
+
+    def debug(self, event, **fields):
+        self.log(DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(ERROR, event, **fields)
+
+    def stop(self):
+        """Write out whatever is left and stop the writer."""
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+        self.write()
+
+    def write(self):
+        lines = []
+        while self.ring:
+            lines.append(self.render(*self.ring.popleft()))
+
+        if self.overwritten:
+            (lost, self.overwritten) = (self.overwritten, 0)
+            lines.append(self.render(time.time(), WARNING, "log_overflow", {"lost": lost}))
+
+        if lines:
+            try:
+                self.stream.write("".join(lines))
+                self.stream.flush()
+            except (OSError, ValueError):
+                # Nowhere left to write to
+                pass
+
+    def render(self, when, level, event, fields):
+        if self.format == "json":
+            record = {"time": round(when, 6), "level": NAMES[level], "event": event}
+            record.update(self.fields)
+            record.update(fields)
+            return json.dumps(record, default=str) + "\n"
+
+        text = "[" + time.strftime("%H:%M:%S", time.localtime(when)) + "] " + NAMES[level] + " " + event
+        for (key, value) in itertools.chain(self.fields.items(), fields.items()):
+            value = str(value)
+            if not value or " " in value or '"' in value or "=" in value:
+                value = json.dumps(value)
+            text += " " + key + "=" + value
+        return text + "\n"
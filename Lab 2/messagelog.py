@@ -0,0 +1,271 @@
+"""
+Durable message log for myserver.py.
+
+Messages are appended to numbered segment files in a directory, each record
+being a header (body length, CRC32, timestamp, room length), the room and
+the message exactly as sent. Rooms are "" for messages to everyone,
+"#channel" for channels and "@user" for private messages. Every indexEvery
+records a (record number, timestamp, file position) entry goes in the
+segment's .idx file, so a read can start near any point in time without
+scanning from the start.
+
+Appending only queues the record; a background thread writes batches and
+fsyncs at most every syncInterval seconds, so a crash loses at most that
+much. Reads map the segment files with mmap rather than reading them in.
+"""
+
+import os, mmap, time, zlib, struct, bisect, threading, collections
+
+
+# Body length, CRC32 of room and body, timestamp, room length
+HEADER = struct.Struct(">IIdH")
+
+# Record number, timestamp, position in the segment
+INDEX = struct.Struct(">QdQ")
+
+
+class Segment:
+    """One log file and its sparse index."""
+
+    def __init__(self, directory, first):
+        self.first = first
+        self.path = os.path.join(directory, "%020d.log" % first)
+        self.indexPath = os.path.join(directory, "%020d.idx" % first)
+
+        # [(record number, timestamp, position)], ascending
+        self.index = []
+
+        # Bytes and records written and flushed, readers go no further
+        self.size = 0
+        self.count = 0
+
+
+class MessageLog:
+    """Appends messages to segment files from a background thread and reads them back."""
+
+    def __init__(self, directory, segmentBytes=16 << 20, indexEvery=64, syncInterval=0.2):
+        self.directory = directory
+        self.segmentBytes = segmentBytes
+        self.indexEvery = indexEvery
+        self.syncInterval = syncInterval
+        os.makedirs(directory, exist_ok=True)
+
+        # Guards the list of segments and their sizes and indexes
+        self.lock = threading.Lock()
+        self.segments = []
+        self.recover()
+
+        self.file = open(self.segments[-1].path, "ab")
+        self.indexFile = open(self.segments[-1].indexPath, "ab")
+
+        # Records waiting for the writer, appended from any thread
+        self.pending = collections.deque()
+        self.wake = threading.Event()
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, room, message):
+        """Queue a message to be written, never waits on the disk."""
+        self.pending.append((time.time(), room, message))
+        self.wake.set()
+
+    def stop(self):
+        """Write and sync everything queued, then close the files."""
+        self.stopped = True
+        self.wake.set()
+        self.thread.join()
+        self.file.close()
+        self.indexFile.close()
+
+    # Writing
+
+    def run(self):
+        unsynced = False
+        lastSync = time.monotonic()
+
+        while True:
+            # With unsynced data, only wait until it is due to be synced
+            timeout = max(lastSync + self.syncInterval - time.monotonic(), 0) if unsynced else None
+            self.wake.wait(timeout)
+            self.wake.clear()
+
+            if self.pending:
+                self.write()
+                unsynced = True
+
+            if unsynced and (self.stopped or time.monotonic() >= lastSync + self.syncInterval):
+                os.fsync(self.file.fileno())
+                lastSync = time.monotonic()
+                unsynced = False
+
+            if self.stopped and not self.pending:
+                break
+
+    def write(self):
+        segment = self.segments[-1]
+        size = segment.size
+        count = segment.count
+        entries = []
+
+        while self.pending:
+            (when, room, message) = self.pending.popleft()
+            room = room.encode()
+            record = HEADER.pack(len(message), zlib.crc32(message, zlib.crc32(room)), when, len(room)) + room + message
+
+            if size + len(record) > self.segmentBytes and count > 0:
+                # Publish what is in this segment before starting the next
+                self.publish(segment, size, count, entries)
+                segment = self.roll(segment.first + count)
+                (size, count, entries) = (0, 0, [])
+
+            if count % self.indexEvery == 0:
+                entries.append((segment.first + count, when, size))
+            self.file.write(record)
+            size += len(record)
+            count += 1
+
+        self.publish(segment, size, count, entries)
+
+    def publish(self, segment, size, count, entries):
+        # Readers only look at what has reached the file
+        self.file.flush()
+        for entry in entries:
+            self.indexFile.write(INDEX.pack(*entry))
+        self.indexFile.flush()
+
+        with self.lock:
+            segment.index.extend(entries)
+            segment.size = size
+            segment.count = count
+
+    def roll(self, first):
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.indexFile.close()
+
+        segment = Segment(self.directory, first)
+        self.file = open(segment.path, "ab")
+        self.indexFile = open(segment.indexPath, "ab")
+        with self.lock:
+            self.segments.append(segment)
+        return segment
+
+    # Recovery
+
+    def recover(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".log"))
+        for name in names:
+            segment = Segment(self.directory, int(name[:-4]))
+            segment.size = os.path.getsize(segment.path)
+
+            try:
+                with open(segment.indexPath, "rb") as indexFile:
+                    data = indexFile.read()
+            except FileNotFoundError:
+                data = b""
+            for offset in range(0, len(data) - INDEX.size + 1, INDEX.size):
+                entry = INDEX.unpack_from(data, offset)
+                if entry[2] < segment.size:
+                    segment.index.append(entry)
+
+            self.segments.append(segment)
+
+        if not self.segments:
+            self.segments.append(Segment(self.directory, 0))
+            return
+
+        # Only the last segment can end in a record cut short by a crash,
+        # count its records from the last index entry and cut any partial one
+        segment = self.segments[-1]
+        (first, when, position) = segment.index[-1] if segment.index else (segment.first, 0, 0)
+        count = first - segment.first
+        for (when, room, body, end) in self.scan(segment, position, segment.size, check=True):
+            position = end
+            count += 1
+        if position < segment.size:
+            with open(segment.path, "r+b") as logFile:
+                logFile.truncate(position)
+        segment.count = count
+        if position < segment.size or any(entry[2] >= position for entry in segment.index):
+            # Entries past the cut would point into records written later
+            segment.index = [entry for entry in segment.index if entry[2] < position]
+            with open(segment.indexPath, "wb") as indexFile:
+                indexFile.write(b"".join(INDEX.pack(*entry) for entry in segment.index))
+        segment.size = position
+
+        # Earlier segments are complete, the next one starts where they end
+        for (segment, following) in zip(self.segments, self.segments[1:]):
+            segment.count = following.first - segment.first
+
+    # Reading
+
+    def scan(self, segment, start, end, check=False):
+        """Yield (timestamp, room, body, end position) for the records in segment between start and end."""
+        if end <= start:
+            return
+
+        with open(segment.path, "rb") as logFile:
+            with mmap.mmap(logFile.fileno(), end, access=mmap.ACCESS_READ) as view:
+                position = start
+                while position + HEADER.size <= end:
+                    (length, crc, when, roomLength) = HEADER.unpack_from(view, position)
+                    roomStart = position + HEADER.size
+                    bodyStart = roomStart + roomLength
+                    bodyEnd = bodyStart + length
+                    if bodyEnd > end:
+                        break
+
+                    room = view[roomStart:bodyStart]
+                    body = view[bodyStart:bodyEnd]
+                    if check and zlib.crc32(body, zlib.crc32(room)) != crc:
+                        break
+
+                    yield (when, room.decode(errors="replace"), body, bodyEnd)
+                    position = bodyEnd
+
+    def snapshot(self):
+        # [(segment, size, index)] as far as has been written
+        with self.lock:
+            return [(segment, segment.size, list(segment.index)) for segment in self.segments]
+
+    def since(self, timestamp, room, count):
+        """Up to count messages in room from timestamp onwards, oldest first."""
+        segments = self.snapshot()
+
+        # Start in the last segment beginning at or before timestamp
+        starts = [index[0][1] if index else float("inf") for (segment, size, index) in segments]
+        first = max(bisect.bisect_right(starts, timestamp) - 1, 0)
+
+        messages = []
+        for (segment, size, index) in segments[first:]:
+            # Start from the last index entry at or before timestamp
+            position = 0
+            times = [entry[1] for entry in index]
+            at = bisect.bisect_right(times, timestamp) - 1
+            if at >= 0:
+                position = index[at][2]
+
+            for (when, recordRoom, body, end) in self.scan(segment, position, size):
+                if when >= timestamp and recordRoom == room:
+                    messages.append(body)
+                    if len(messages) >= count:
+                        return messages
+        return messages
+
+    def tail(self, room, count):
+        """The last count messages in room, oldest first."""
+        messages = collections.deque()
+
+        # Work backwards a stretch between index entries at a time, so only
+        # the end of the log is looked at
+        for (segment, size, index) in reversed(self.snapshot()):
+            bounds = [entry[2] for entry in index] or [0]
+            ends = bounds[1:] + [size]
+            for (start, end) in reversed(list(zip(bounds, ends))):
+                found = [body for (when, recordRoom, body, stop) in self.scan(segment, start, end) if recordRoom == room]
+                messages.extendleft(reversed(found))
+                if len(messages) >= count:
+                    return list(messages)[-count:]
+        return list(messages)
@@ -0,0 +1,213 @@
+"""
+Live metrics for myserver.py.
+
+Counters and histograms are plain attributes updated in place, cheap
+enough to leave on all the time. Increments from several threads are not
+locked, so under heavy contention a count can occasionally come out a
+little low. Everything can be rendered in the Prometheus text format and
+served from a local HTTP endpoint.
+"""
+
+import time, bisect, threading, collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Histogram:
+    """Counts of observations falling under each of a fixed set of bounds."""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        # One more for observations over the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of observations."""
+        target = fraction * self.count
+        seen = 0
+        for (bound, count) in zip(self.bounds + (float("inf"),), self.counts):
+            seen += count
+            if seen >= target and seen > 0:
+                return bound
+        return 0
+
+
+class TimedLock:
+    """A lock that adds up how long acquiring it had to wait."""
+
+    __slots__ = ("lock", "waited", "contended")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waited = 0.0
+        self.contended = 0
+
+    def acquire(self):
+        # Only time the slow path, an uncontended acquire costs nothing extra
+        if self.lock.acquire(False):
+            return True
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.waited += time.perf_counter() - start
+        self.contended += 1
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exception):
+        self.release()
+
+
+class Metrics:
+    """
+    Everything measured about one server.
+
+    Rates are worked out from samples of the traffic counters taken once a
+    second by a background thread, over the last window seconds.
+    """
+
+    window = 10
+
+    def __init__(self, server):
+        self.server = server
+        self.started = time.time()
+
+        # Seconds spent in onMessage
+        self.handlerLatency = Histogram((0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1))
+
+        # Recipients per broadcast or channel message
+        self.fanout = Histogram((1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+
+        # Command name -> times used, unknown commands share one entry
+        self.commands = collections.Counter()
+
+        # Name -> TimedLock, for the locks worth watching
+        self.locks = {}
+
+        # (time, traffic stats), one a second
+        self.samples = collections.deque(maxlen=self.window + 1)
+        self.http = None
+        self.running = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def lock(self, name):
+        """A TimedLock reported under name."""
+        lock = self.locks[name] = TimedLock()
+        return lock
+
+    def sample(self):
+        while not self.running.wait(1):
+            self.samples.append((time.monotonic(), self.server.trafficStats()))
+
+    def stop(self):
+        self.running.set()
+        self.thread.join()
+        if self.http != None:
+            self.http.shutdown()
+            self.http.server_close()
+
+    def rates(self):
+        """Traffic per second over the last window."""
+        now = (time.monotonic(), self.server.trafficStats())
+        then = self.samples[0] if self.samples else (now[0] - (time.time() - self.started), dict.fromkeys(now[1], 0))
+        seconds = max(now[0] - then[0], 0.001)
+        return {key: (now[1][key] - then[1][key]) / seconds for key in now[1]}
+
+    def snapshot(self):
+        """Every metric as (name, type, help, [(labels, value)])."""
+        server = self.server
+        traffic = server.trafficStats()
+        queues = server.queueStats()
+
+        metrics = [
+            ("chat_connections", "gauge", "Open connections", [({}, queues["connections"])]),
+            ("chat_users", "gauge", "Connected users with a name", [({}, len(server.clients))]),
+            ("chat_uptime_seconds", "gauge", "Seconds since the server started", [({}, time.time() - self.started)]),
+            ("chat_messages_received_total", "counter", "Messages received from clients", [({}, traffic["messages_in"])]),
+            ("chat_messages_sent_total", "counter", "Messages sent to clients", [({}, traffic["messages_out"])]),
+            ("chat_received_bytes_total", "counter", "Bytes received from clients", [({}, traffic["bytes_in"])]),
+            ("chat_sent_bytes_total", "counter", "Bytes sent to clients", [({}, traffic["bytes_out"])]),
+            ("chat_outbound_queued_bytes", "gauge", "Bytes waiting to be sent to clients", [({}, queues["queued_bytes"])]),
+            ("chat_outbound_queued_bytes_max", "gauge", "Most bytes waiting for one client", [({}, queues["max_queued_bytes"])]),
+            ("chat_congested_clients", "gauge", "Clients over the outbound queue limit", [({}, queues["congested"])]),
+            ("chat_outbound_dropped_total", "counter", "Messages dropped for slow clients", [({}, queues["dropped"])]),
+            ("chat_evicted_total", "counter", "Slow clients disconnected", [({}, queues["evicted"])]),
+            ("chat_commands_total", "counter", "Commands used, by command",
+                [({"command": name}, count) for (name, count) in sorted(self.commands.items())]),
+            ("chat_lock_wait_seconds_total", "counter", "Time spent waiting for locks",
+                [({"lock": name}, lock.waited) for (name, lock) in sorted(self.locks.items())]),
+            ("chat_lock_contended_total", "counter", "Lock acquisitions that had to wait",
+                [({"lock": name}, lock.contended) for (name, lock) in sorted(self.locks.items())]),
+            ("chat_handler_seconds", "histogram", "Time taken to handle a message", self.handlerLatency),
+            ("chat_fanout_recipients", "histogram", "Recipients per broadcast or channel message", self.fanout),
+        ]
+
+        if server.sessions != None:
+            metrics.append(("chat_suspended_sessions", "gauge", "Dropped clients whose session is held for them to resume",
+                [({}, server.sessions.suspendedCount())]))
+
+        if server.limiter != None:
+            metrics.append(("chat_rate_limited_total", "counter", "Lines over a rate limit, by outcome and command",
+                [({"outcome": outcome, "command": command}, count) for ((outcome, command), count) in sorted(server.limiter.counts.items())]))
+
+        return metrics
+
+    def prometheus(self):
+        """Every metric in the Prometheus text exposition format."""
+        lines = []
+        for (name, kind, description, values) in self.snapshot():
+            lines.append("# HELP " + name + " " + description)
+            lines.append("# TYPE " + name + " " + kind)
+
+            if kind == "histogram":
+                cumulative = 0
+                for (bound, count) in zip(values.bounds + (float("inf"),), values.counts):
+                    cumulative += count
+                    lines.append(name + '_bucket{le="' + ("+Inf" if bound == float("inf") else repr(bound)) + '"} ' + str(cumulative))
+                lines.append(name + "_sum " + repr(values.sum))
+                lines.append(name + "_count " + str(values.count))
+                continue
+
+            for (labels, value) in values:
+                text = ",".join(key + '="' + str(label).replace("\\", "\\\\").replace('"', '\\"') + '"' for (key, label) in labels.items())
+                lines.append(name + ("{" + text + "}" if text else "") + " " + repr(value))
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, address="127.0.0.1"):
+        """Serve prometheus() at http://address:port/metrics from a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # Scrapes would flood the server's own log
+                pass
+
+        self.http = ThreadingHTTPServer((address, port), Handler)
+        self.http.daemon_threads = True
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
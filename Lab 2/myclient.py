@@ -1,64 +1,300 @@
-import sys
+import sys, time, selectors, collections
 from ex2utils import Client, Receiver
-
-import time
+from terminal import Terminal
 
 class IRCClient(Client):
-    def __init__(self):
+    # Seconds before the first go at reconnecting, doubling after each one
+    # that fails up to the longest wait, and how many goes before giving up
+    retry_first = 0.25
+    retry_longest = 10
+    retry_attempts = 10
+
+    def __init__(self, terminal):
         # Call super init constructor, required in order to extend
-        # __init__ and add other attributes to this class 
+        # __init__ and add other attributes to this class
         Receiver.__init__(self)
 
+        # Where messages are shown and lines are typed
+        self.terminal = terminal
+
+        # (ip, port) of the server, to reconnect to
+        self.address = None
+
         self.name = ""
         self.name_accepted = False
 
-        self.disconnect = False
+        # Channel plain messages go to, None when they go to everyone
+        self.channel = None
+
+        # Everyone connected, kept up to date from the server's presence feed
+        # (folded name -> name), and the version it is up to. The version is
+        # None until the full list arrives
+        self.roster = {}
+        self.presence_version = None
+
+        # Lines typed but not sent yet. A name has to be answered before the
+        # next line can be sent, as it might be another go at a name
+        self.typed = collections.deque()
+        self.awaiting_name = False
+        self.input_closed = False
+
+        # Session to resume if the connection drops, and how many of the
+        # messages numbered by the server since the name was accepted have
+        # arrived. None without a session
+        self.token = None
+        self.received = 0
+
+        # Set from losing the connection until a new one has resumed the
+        # session, and when to try connecting again
+        self.lost = False
+        self.retry_at = None
+        self.retries = 0
+
+        self.leaving = False
+        self.disconnected = False
+
+    def prompt(self):
+        if not self.name_accepted:
+            return "[CLIENT] Enter a display name: "
+        if self.channel == None:
+            return "[" + self.name + "]: "
+        return "[" + self.name + " " + self.channel + "]: "
 
     def onMessage(self, socket, message):
         message = message.strip()
 
-        if message == "100":
-            # Name approved
+        if self.lost:
+            # A new connection, only the answer to /resume matters
+            self.resumed(message)
+            return True
+
+        if self.token != None:
+            self.received += 1
+
+        if message == "100" or message.startswith("100 "):
+            # Name approved, along with a session to resume should the
+            # connection drop. Keep a list of users locally rather than
+            # asking for it each time
+            self.token = message[4:] or None
+            self.received = 1
             self.name_accepted = True
+            self.awaiting_name = False
+            self.terminal.setPrompt(self.prompt())
+            self.send("/presence".encode())
+            self.sendTyped()
             return True
-        
+
         if message == "200":
             # Disconnect approved
-            self.disconnect = True
+            self.disconnected = True
+            return True
+
+        if message == "400" or message.startswith("400 "):
+            # Joined or left a channel, followed by the server's confirmation
+            self.channel = message[4:] or None
+            self.terminal.setPrompt(self.prompt())
             return True
 
-        # Remove prompt here
-        # Couldn't get this to work
+        if message.startswith("500 "):
+            # Full list of users
+            (version, _, names) = message[4:].partition(' ')
+            self.roster = {name.casefold(): name for name in names.split(',') if name}
+            self.presence_version = int(version)
+            return True
+
+        if message.startswith("501 "):
+            self.updateRoster(message[4:])
+            return True
+
+        # Display message above the line being typed
+        self.terminal.show(message)
+
+        if self.awaiting_name:
+            # Name rejected, the next line is another go
+            self.awaiting_name = False
+            self.sendTyped()
+        return True
+
+    def onDisconnect(self, socket):
+        if self.leaving or self.token == None or self.disconnected:
+            self.disconnected = True
+            return
+
+        if not self.lost:
+            self.lost = True
+            self.terminal.show("[CLIENT] Lost the connection to the server, reconnecting...")
+        self.retryLater()
+
+    def retryLater(self):
+        if self.retries >= self.retry_attempts:
+            self.terminal.show("[CLIENT] Could not reconnect to the server.")
+            self.disconnected = True
+            return
+
+        self.retry_at = time.monotonic() + min(self.retry_first * 2 ** self.retries, self.retry_longest)
+        self.retries += 1
+
+    def retryIn(self):
+        """Seconds until the next go at reconnecting, None if there is nothing to wait for."""
+        if self.retry_at == None:
+            return None
+        return max(self.retry_at - time.monotonic(), 0)
 
-        # Display message
-        print("\n" +message)
+    def reconnect(self):
+        # Connect again and ask to carry on where we were, returns False if
+        # that has to wait for another go
+        self.retry_at = None
+        try:
+            self.start(*self.address, frames=True, threaded=False)
+        except OSError:
+            self.retryLater()
+            return False
 
-        # Replace prompt here
-        # Couldn't get this to work either
+        if self._connection == None:
+            # Dropped again straight away
+            return False
+
+        # In case the session has expired and a name has to be picked again
+        self.send("/session".encode())
+
+        self.send(("/resume " + self.token + " " + str(self.received)).encode())
         return True
 
+    def resumed(self, message):
+        if message.startswith("110 "):
+            # Back, followed by everything from message number first on
+            first = int(message[4:])
+            missed = first - 1 - self.received
+            self.received = first - 1
+            self.lost = False
+            self.retries = 0
+            self.terminal.show("[CLIENT] Reconnected." + (" " + str(missed) + " messages were missed." if missed > 0 else ""))
+            self.sendTyped()
+
+        elif message == "120":
+            # Held for too long, start again with the same name
+            self.lost = False
+            self.retries = 0
+            self.token = None
+            self.name_accepted = False
+            self.presence_version = None
+            self.channel = None
+            self.terminal.show("[CLIENT] Reconnected, but the session had expired.")
+            self.terminal.setPrompt(self.prompt())
+            self.typed.appendleft(self.name)
+            self.sendTyped()
+
+    def updateRoster(self, change):
+        # A single user joined (+name) or left (-name)
+        (version, _, change) = change.partition(' ')
+        version = int(version)
+
+        if self.presence_version == None or version <= self.presence_version:
+            # Waiting for the full list, or already part of it
+            return
+
+        if version != self.presence_version + 1:
+            # Missed a change, start again from a fresh list
+            self.presence_version = None
+            self.send("/presence".encode())
+            return
+
+        if change.startswith('+'):
+            self.roster[change[1:].casefold()] = change[1:]
+        else:
+            self.roster.pop(change[1:].casefold(), None)
+        self.presence_version = version
+
+    def typedLines(self, lines):
+        if lines == None:
+            # End of input, leave once everything typed has been sent
+            self.input_closed = True
+        else:
+            self.typed.extend(lines)
+        self.sendTyped()
+
+    def sendTyped(self):
+        while self.typed and not self.awaiting_name and not self.leaving and not self.lost:
+            message = self.typed.popleft()
+
+            if not self.name_accepted:
+                self.name = message
+                self.awaiting_name = True
+                self.send(message.encode())
+                continue
+
+            command = message.strip().lower().split(' ')[0]
+            if command == "/users" and self.presence_version != None:
+                # Answered from the local list, no need to ask the server
+                self.terminal.show("[SERVER] Connected users: " + ', '.join(sorted(self.roster.values())))
+                continue
+
+            self.send(message.encode())
+            if command == "/disconnect":
+                self.leaving = True
+
+        if self.input_closed and not self.typed and not self.awaiting_name and not self.leaving and not self.lost:
+            if self.name_accepted:
+                self.leaving = True
+                self.send("/disconnect".encode())
+            else:
+                # Never got as far as a name, nothing to say goodbye to
+                self.disconnected = True
+
 # Parse the IP address and port you wish to connect to.
 ip = sys.argv[1]
 port = int(sys.argv[2])
 
-# Create an IRC client.
-client = IRCClient()
-
-# Start server
-client.start(ip, port)
+with Terminal() as terminal:
+    # Create an IRC client.
+    client = IRCClient(terminal)
+    client.address = (ip, port)
 
-# Sleep to allow time for server to display messages 
-time.sleep(2)
+    # Connect, using length-prefixed frames so multi-line messages such as
+    # /help arrive whole. Messages from the server and lines typed are both
+    # waited for here, on this one thread, so each is dealt with as soon as
+    # it arrives
+    try:
+        client.start(*client.address, frames=True, threaded=False)
+        if client._connection != None:
+            # Ask for a session, so a dropped connection can be resumed
+            client.send("/session".encode())
+    except OSError as error:
+        terminal.show("[CLIENT] Could not connect to the server: " + str(error))
+        sys.exit(1)
+    terminal.setPrompt(client.prompt())
 
-while not client.name_accepted:
-    name = input("[CLIENT] Enter a display name: ")
-    client.send(name.encode())
+    selector = selectors.DefaultSelector()
+    if client._connection == None:
+        # Closed while starting, such as when the server is full. Anything
+        # it said first has already been shown
+        terminal.show("[CLIENT] Disconnected by the server.")
+        client.disconnected = True
+    else:
+        selector.register(client, selectors.EVENT_READ)
+    selector.register(terminal, selectors.EVENT_READ)
 
-client.name = name
+    try:
+        while not client.disconnected:
+            for (key, mask) in selector.select(client.retryIn()):
+                if key.fileobj is client:
+                    if not client.receive():
+                        selector.unregister(client)
+                else:
+                    lines = terminal.read()
+                    if lines != None and terminal.ended:
+                        # Lines finished before a Ctrl-D, the end of input
+                        # follows straight away
+                        client.typedLines(lines)
+                        lines = terminal.read()
+                    if lines == None:
+                        selector.unregister(terminal)
+                    client.typedLines(lines)
 
-while not client.disconnect:
-    message = input("[" + client.name + "]: ")
-    client.send(message.encode())
+            if client.retryIn() == 0 and client.reconnect():
+                selector.register(client, selectors.EVENT_READ)
+    except KeyboardInterrupt:
+        pass
 
-client.stop()
-	
+    selector.close()
+    client.stop()
@@ -1,128 +1,562 @@
-import sys, time
-from ex2utils import Server
+import os, time, hmac, argparse, itertools, importlib, traceback
+from ex2utils import Server, Message
+from registry import Registry, Channels
+from presence import Presence
+from sessions import Sessions
+from scrollback import Scrollback
+from messagelog import MessageLog
+from ratelimit import Limiter, Deferred, parseLimit
+from metrics import Metrics
+from commands import CommandTable
+import eventlog, cluster
 
 # Create an echo server class
 class EchoServer(Server):
 
+    # Shared user namespace when running as one of several worker processes
+    bus = None
+
+    # Least severe log level written, events to sample (event -> keep one
+    # in N) and the log format, text or json
+    logLevel = eventlog.INFO
+    logSample = {}
+    logFormat = "text"
+
+    # Messages kept per room and their total size, and how many to show a
+    # user once their name is accepted
+    historyDepth = 100
+    historyBytes = 65536
+    replayOnJoin = 0
+
+    # Directory to keep every message in, or None to keep them only in memory
+    archiveDirectory = None
+    archiveSegmentBytes = 16 << 20
+    archiveSyncInterval = 0.2
+
+    # Flood control: (rate, burst) for every line a client sends, the same
+    # for particular commands ("message" for plain messages), and whether
+    # lines over a limit are queued, dropped or get the client disconnected
+    lineLimit = None
+    commandLimits = {}
+    floodPolicy = "queue"
+    floodHeld = 50
+
+    # Password for /admin, which unlocks /stats, and a local port to serve
+    # metrics on for Prometheus. Both are off when None
+    adminPassword = None
+    metricsPort = None
+
+    # Seconds a dropped connection's session is held for it to resume, 0 for
+    # none, and messages kept to send it again once it does. Only clients
+    # that send /session before their name get one
+    sessionTimeout = 30
+    sessionMessages = 1000
+
     def onStart(self):
-        print("Server started at " + time.strftime("%H:%M:%S"))
-        print("SERVER LOG:")
-        print("=" * 10)
+        # Several workers share one output, so say which one each record is from
+        fields = {"worker": os.getpid()} if self.bus != None else {}
+        self.log = eventlog.Logger(level=self.logLevel, sample=self.logSample, format=self.logFormat, fields=fields)
+        self.log.info("server_started")
 
-        # List of all available command words
-        self.COMMANDS = ["ping", "users", "whisper", "all", "help", "disconnect"]
+        # Numbers each connection so its records can be followed
+        self.connection_ids = itertools.count(1)
 
         # No initial connections
         self.connections = 0
 
         # Reserve certain names so users cannot impersonate other roles
         self.CLIENT_NAME_BLACKLIST = ["admin"]
-        self.client_names = []
 
-        # Stored to enable messaging and server notifications 
-        self.client_sockets = []
+        # Named clients, stored to enable messaging and server notifications
+        self.clients = Registry()
+
+        # Users joining and leaving, for clients following /presence
+        self.presence = Presence(self.clients.names)
+
+        # Who is in each channel, so channel messages only go to its members
+        self.channels = Channels()
+
+        # Sessions a client can resume after losing its connection. A new
+        # connection may well land on a different worker, so not with those
+        self.sessions = None
+        if self.sessionTimeout > 0 and self.bus == None:
+            self.sessions = Sessions(self.sessionTimeout, self.sessionMessages, self.expireSession)
+
+        # Recent messages to everyone and in each channel
+        self.history = Scrollback(self.historyDepth, self.historyBytes)
+
+        self.archive = None
+        if self.archiveDirectory != None:
+            self.archive = MessageLog(self.archiveDirectory, self.archiveSegmentBytes, syncInterval=self.archiveSyncInterval)
+
+            # Pick up the conversation where it was before a restart
+            for message in self.archive.tail("", self.historyDepth):
+                self.history.record(None, Message(message))
+
+        self.limiter = None
+        self.deferred = None
+        if self.lineLimit != None or self.commandLimits:
+            self.limiter = Limiter(self.lineLimit, self.commandLimits, self.floodPolicy, self.floodHeld)
+            if self.floodPolicy == "queue":
+                self.deferred = Deferred(self.timeLine, self.onError)
+
+        # Connections are handled concurrently, so the counter above is only
+        # touched while holding this lock. The registry has its own, and sends
+        # happen outside both so a slow client cannot hold up anyone else.
+        # All three report how long they are waited on.
+        self.metrics = Metrics(self)
+        self.clients_lock = self.metrics.lock("clients")
+        self.clients.lock = self.metrics.lock("registry")
+        self.channels.lock = self.metrics.lock("channels")
+        self.presence.lock = self.metrics.lock("presence")
+        if self.metricsPort != None:
+            self.metrics.serve(self.metricsPort)
+
+        if self.bus != None:
+            self.bus.start(self)
         
     def onConnect(self, socket):
+        socket.id = next(self.connection_ids)
         socket.name = ""
         socket.assigned_name = False
+        socket.admin = False
+
+        # Channels joined, and the one plain messages go to (None for everyone)
+        socket.channels = set()
+        socket.channel = None
+
+        # Resumable session, whether the client asked for one, and whether
+        # it asked to leave rather than losing its connection
+        socket.session = None
+        socket.wantsSession = False
+        socket.leaving = False
+
+        if self.limiter != None:
+            self.limiter.attach(socket)
 
         socket.send("[SERVER] You are now connected".encode())
         socket.send("[SERVER] (TELNET CLIENT ONLY) Take care when typing inputs, if backspace, arrow keys, or similar are pressed the server will be unable to process it correctly".encode())
 
-        self.connections += 1
-        print("[" + time.strftime("%H:%M:%S") + "] New client is connecting. " + str(self.connections) + " connections are now open.")
+        with self.clients_lock:
+            self.connections += 1
+            connections = self.connections
+        self.log.info("connect", conn=socket.id, connections=connections)
         
         
     def onMessage(self, socket, message):
-        print("[" + time.strftime("%H:%M:%S") + "] Message recieved from " + (socket.name.upper() if socket.assigned_name == True else "connecting client"))
+        self.log.debug("message", conn=socket.id, user=socket.name, length=len(message))
+
+        line = message.strip()
+
+        # Commands are looked up once, for both flood control and handling
+        parsed = None
+        if socket.assigned_name and line.startswith('/'):
+            parsed = self.commands.parse(line)
+
+        if self.limiter != None:
+            return self.limitLine(socket, line, parsed)
+        return self.timeLine(socket, line, parsed)
+
+    def timeLine(self, socket, line, parsed):
+        # Lines held back by flood control come here too once released
+        start = time.perf_counter()
+        result = self.handleLine(socket, line, parsed)
+        self.metrics.handlerLatency.observe(time.perf_counter() - start)
+        return result
+
+    def limitLine(self, socket, line, parsed):
+        # What the line counts against: the command's name, "message" for
+        # plain messages, or None for a name
+        if parsed != None:
+            kind = parsed[0]
+        elif socket.assigned_name:
+            kind = "message"
+        else:
+            kind = None
+
+        # Lines already held back go first, so new ones queue behind them
+        if self.deferred == None or not self.deferred.waiting(socket):
+            delay = self.limiter.check(socket, kind)
+            if delay == 0:
+                return self.timeLine(socket, line, parsed)
+        else:
+            delay = 0
+
+        policy = self.limiter.policy
+        counted = kind or "name"
+
+        if policy == "disconnect":
+            self.limiter.counts["disconnected", counted] += 1
+            self.log.warning("flood_disconnect", conn=socket.id, user=socket.name, kind=counted)
+            socket.leaving = True
+            socket.send("[SERVER] Disconnected for sending messages too quickly.".encode())
+            return False
+
+        if policy == "queue" and len(socket.held) < self.limiter.maxHeld:
+            self.limiter.counts["queued", counted] += 1
+            self.deferred.hold(socket, kind, line, parsed, delay)
+            if self.limiter.notice(socket):
+                socket.send("[SERVER] You are sending messages too quickly, they will be delayed.".encode())
+            return True
+
+        self.limiter.counts["dropped", counted] += 1
+        if self.limiter.notice(socket):
+            socket.send("[SERVER] You are sending messages too quickly, some were not sent.".encode())
+        return True
 
-        message_array = message.strip().split(' ')
+    def handleLine(self, socket, line, parsed=None):
+        if socket.assigned_name == False and line.startswith("/resume"):
+            self.resumeSession(socket, line)
+            return True
+
+        if socket.assigned_name == False and line == "/session":
+            # A client able to resume asks for a session before its name.
+            # Telnet users never do, so they are not held after dropping
+            socket.wantsSession = True
+            return True
 
         if socket.assigned_name == False:
-            name = message.strip().lower()
+            name = line.lower()
             # Check the name is valid
             if not name.isalnum() or len(name) > 8 :
                 socket.send("[SERVER] Names should contain alphanumeric characters only and be at most 8 characters long".encode())
-            elif name in self.client_names:
-                socket.send("[SERVER] Name is already taken (names are case insensitive)".encode())
             elif name in self.CLIENT_NAME_BLACKLIST:
                 socket.send("[SERVER] Protected name is not allowed".encode())
             else:
-                # Name is valid, set socket values
-                socket.name = name
-                socket.assigned_name = True
-                
-                # Set server values 
-                self.client_names.append(name)
-                self.client_sockets.append(socket)
+                others = self.registerClient(socket, name)
 
-                self.sendToUser("100", socket.name, hidden=True)
+                if others == None:
+                    socket.send("[SERVER] Name is already taken (names are case insensitive)".encode())
+                else:
+                    if self.replayOnJoin > 0:
+                        self.replay(socket, None, self.replayOnJoin)
 
-                print("[" + time.strftime("%H:%M:%S") + "] Client '" + name.upper() + "' connected. ")
-                self.sendToAll("User " + name.upper() + " has connected. There are " + str(self.connections - 1) + " other people connected.")
+                    self.log.info("register", conn=socket.id, user=name)
+                    self.sendToAll("User " + name.upper() + " has connected. There are " + str(others) + " other people connected.")
 
             return True
 
-        if message_array[0].startswith('/'):
-            command = message_array[0][1:].lower()
-            params = message_array[1:]
+        if line.startswith('/'):
+            # Not parsed yet if the name was accepted after the line arrived
+            return self.processCommand(socket, parsed or self.commands.parse(line))
 
-            print("[" + time.strftime("%H:%M:%S") + "] Command recieved - Command: " + command + ", Parameters: " + ', '.join(message_array[1:]))
+        if socket.channel != None:
+            self.sendToChannel(line, socket.channel, socket.name)
+        else:
+            self.sendToAll(line, socket.name)
+        return True
 
-            return self.processCommand(socket, command, params)
+    def resumeSession(self, socket, line):
+        # '/resume <token> <messages received>' in place of a name
+        args = line.split()
+        resumed = None
+        if self.sessions != None and len(args) == 3 and args[2].isdigit():
+            # 110 <first message resent> goes ahead of what was missed
+            greeting = lambda first: socket.send(("110 " + str(first)).encode())
+            resumed = self.sessions.resume(args[1], socket, int(args[2]), greeting)
+
+        if resumed == None:
+            # Expired or never existed, the client has to pick a name again
+            socket.send("120".encode())
+            self.log.info("resume_refused", conn=socket.id)
+            return
+
+        (previous, first) = resumed
+        socket.name = previous.name
+        socket.assigned_name = True
+        socket.admin = previous.admin
+        socket.channel = previous.channel
+
+        # Everything sent to the old socket is now passed on to this one, so
+        # nothing is lost while it takes the old one's place
+        self.clients.replace(socket.name, previous, socket)
+        for channel in list(previous.channels):
+            self.channels.part(channel, previous)
+            if self.channels.join(channel, socket):
+                socket.channels.add(channel)
+        self.presence.transfer(previous, socket)
+
+        # The old connection may not have noticed it was dropped yet
+        previous.disconnect()
+
+        self.log.info("resume", conn=socket.id, user=socket.name, previous=previous.id, resent=socket.session.journal.sequence + 1 - first)
+
+    def registerClient(self, socket, name):
+        # Check and claim the name in one step so two clients cannot both take
+        # it. Returns how many other people are connected, or None if taken.
+        if self.bus != None:
+            # Names are shared between processes, so the hub decides
+            others = self.bus.claim(name)
+            if others == None:
+                return None
+
+        socket.name = name
+        if not self.clients.add(name, socket, lambda: self.welcome(socket)):
+            socket.name = ""
+            return None
+
+        # Name is valid
+        socket.assigned_name = True
+
+        if self.bus == None:
+            # With workers the hub numbers joins and sends them to everyone
+            self.presence.publish(socket.name, True)
+            with self.clients_lock:
+                others = self.connections - 1
+
+        return others
+
+    def welcome(self, socket):
+        # The hidden code accepting a name, sent before the user can be found
+        # so it arrives ahead of anything sent to everyone
+        if self.sessions != None and socket.wantsSession:
+            # Messages are numbered from this one on
+            socket.send(("100 " + self.sessions.start(socket)).encode())
+        else:
+            socket.send("100".encode())
 
-        self.sendToAll(' '.join(message_array), socket.name)
-        return True
+    def processCommand(self, socket, parsed):
+        (name, command, args) = parsed
 
-    def processCommand(self, socket, command, params):
-        if command == "ping":
-            self.sendToUser("Pong, connected to server.", socket.name)
-            return True
+        self.log.debug("command", conn=socket.id, user=socket.name, command=name, params=len(args or ()))
 
-        if command == "users":
-            self.sendToUser("Connected users: " + ', '.join(self.client_names), socket.name)
-            return True
-        
-        if command == "help":
-            self.sendToUser(""" 
-            Available commands:
-                /ping - Should recieve 'pong' back from the server. Can be used to check if you are succesfully connected 
-                /users - Get names of all the currently connected clients
-                /help - Display this help message
-                /all <message> - Send a message to all users
-                /whisper <user> <message> - Send a private message to a specified user, private messages can only be seen by you and the specified recipient
-                /disconnect - Disconnects from the server.
-                """, socket.name)
-            return True
+        self.metrics.commands[name if command != None else "unknown"] += 1
 
-        if command == "all":
-            if len(params) < 1:
-                self.sendToUser("Correct usage: /all <message>", socket.name)
-            else:
-                self.sendToAll(' '.join(params), socket.name)
+        if command == None:
+            # Provided command was not recognised
+            self.sendToUser("[SERVER] Command '" + name + "' was not recognised.", socket.name)
+            self.log.info("unknown_command", conn=socket.id, user=socket.name, command=name)
             return True
-    
 
-        if command == "whisper":
-            if len(params) < 2:
-                self.sendToUser("Correct usage: /whisper <user> <message>", socket.name)
-            else:
-                target_user = params[0]
-                target_message = ' '.join(params[1:])
-                self.sendToUser(target_message, target_user, socket.name)
+        if args == None:
+            self.sendToUser("Correct usage: /" + command.usage, socket.name)
             return True
 
-        if command == "disconnect":
-            self.sendToUser("Disconnecting from server", socket.name)
-            self.sendToAll("User " + socket.name + " has disconnected.")
-            
-            return False
+        # Handlers return False to disconnect the client
+        return command.handler(self, socket, args) != False
+
+    # Built-in commands, listed by /help in this order. Plugins add to the
+    # same table, see commands.py
+    commands = CommandTable()
+
+    @commands.command("ping", help="Should recieve 'pong' back from the server. Can be used to check if you are succesfully connected")
+    def commandPing(self, socket, args):
+        self.sendToUser("Pong, connected to server.", socket.name)
+
+    @commands.command("users", help="Get names of all the currently connected clients")
+    def commandUsers(self, socket, args):
+        if self.bus != None:
+            names = ', '.join(self.bus.names())
+        else:
+            names = ', '.join(self.clients.names())
+        self.sendToUser("Connected users: " + names, socket.name)
+
+    @commands.command("presence", usage="presence [off]", maximum=1,
+                      help="Follow users joining and leaving, for clients keeping their own list of users")
+    def commandPresence(self, socket, args):
+        if args and args[0].lower() == "off":
+            self.presence.unsubscribe(socket)
+        elif args:
+            self.sendToUser("Correct usage: /" + self.commands.get("presence").usage, socket.name)
+        elif self.bus != None:
+            self.presence.subscribe(socket, self.bus.presence())
+        else:
+            # Subscribing again resends the full list
+            self.presence.subscribe(socket)
+
+    @commands.command("help", help="Display this help message")
+    def commandHelp(self, socket, args):
+        lines = ["/" + command.usage + " - " + command.help for command in self.commands]
+        self.sendToUser("\nAvailable commands:\n    " + "\n    ".join(lines), socket.name)
+
+    @commands.command("all", usage="all <message>", help="Send a message to all users", split=0, minimum=1)
+    def commandAll(self, socket, args):
+        self.sendToAll(args[0], socket.name)
+
+    @commands.command("join", usage="join <channel>", help="Join a channel, your messages then only go to people in it", minimum=1, maximum=1)
+    def commandJoin(self, socket, args):
+        channel = self.channelName(args[0])
+        if channel == None:
+            self.sendToUser("Channel names should contain alphanumeric characters only and be at most 16 characters long", socket.name)
+        else:
+            self.joinChannel(socket, channel)
+
+    @commands.command("part", usage="part [channel]", help="Leave a channel, the one you are talking in if none is given", maximum=1)
+    def commandPart(self, socket, args):
+        channel = self.channelName(args[0]) if args else socket.channel
+        if channel == None or channel not in socket.channels:
+            self.sendToUser("You are not in that channel.", socket.name)
+        else:
+            self.partChannel(socket, channel)
+
+    @commands.command("channels", help="List the channels and how many people are in each")
+    def commandChannels(self, socket, args):
+        sizes = self.channels.sizes()
+        if not sizes:
+            self.sendToUser("There are no channels yet, start one with /join <channel>", socket.name)
+        else:
+            listing = ["#" + channel + " (" + str(size) + (", joined" if channel in socket.channels else "") + ")"
+                       for (channel, size) in sorted(sizes.items())]
+            self.sendToUser("Channels: " + ', '.join(listing), socket.name)
+
+    @commands.command("history", usage="history [n] [minutes]", maximum=2,
+                      help="Show the last n messages in the channel you are talking in, or to everyone. Given minutes, show n messages from that long ago")
+    def commandHistory(self, socket, args):
+        if not all(arg.isdigit() for arg in args):
+            self.sendToUser("Correct usage: /history [n] [minutes]", socket.name)
+        elif len(args) < 2:
+            self.replay(socket, socket.channel, int(args[0]) if args else None)
+        elif self.archive == None:
+            self.sendToUser("Older messages are not kept on this server, use /history [n]", socket.name)
+        else:
+            # Read from the log on disk, which goes back further than memory
+            room = "#" + socket.channel if socket.channel != None else ""
+            since = time.time() - int(args[1]) * 60
+            messages = self.archive.since(since, room, int(args[0]))
+            self.showMessages(socket, socket.channel, "from " + args[1] + " minutes ago", [Message(message) for message in messages])
+
+    @commands.command("admin", usage="admin <password>", help="Log in as an administrator", minimum=1, maximum=1)
+    def commandAdmin(self, socket, args):
+        if self.adminPassword != None and hmac.compare_digest(args[0].encode(), self.adminPassword.encode()):
+            socket.admin = True
+            self.log.info("admin", conn=socket.id, user=socket.name)
+            self.sendToUser("You are now logged in as an administrator.", socket.name)
+        else:
+            self.log.warning("admin_refused", conn=socket.id, user=socket.name)
+            self.sendToUser("Incorrect password.", socket.name)
+
+    @commands.command("stats", help="Show how the server is doing (administrators only)")
+    def commandStats(self, socket, args):
+        if not socket.admin:
+            self.sendToUser("Only administrators can use /stats, see /admin.", socket.name)
+            return
+
+        metrics = self.metrics
+        rates = metrics.rates()
+        traffic = self.trafficStats()
+        queues = self.queueStats()
+        latency = metrics.handlerLatency
+        fanout = metrics.fanout
+
+        lines = [
+            "Connections: " + str(queues["connections"]) + " (" + str(len(self.clients)) + " with names)",
+            "Messages per second, last " + str(metrics.window) + "s: %.1f in, %.1f out" % (rates["messages_in"], rates["messages_out"]),
+            "Total: %d messages (%d bytes) in, %d messages (%d bytes) out" % (traffic["messages_in"], traffic["bytes_in"], traffic["messages_out"], traffic["bytes_out"]),
+            "Handling a message: %.3fms average, 99%% under %sms" % (latency.sum / max(latency.count, 1) * 1000, latency.quantile(0.99) * 1000),
+            "Recipients per broadcast: %.1f average, 99%% at most %s" % (fanout.sum / max(fanout.count, 1), fanout.quantile(0.99)),
+            "Lock waits: " + ", ".join("%s %.3fs (%d times)" % (name, lock.waited, lock.contended) for (name, lock) in sorted(metrics.locks.items())),
+            "Outbound queues: %d bytes, at most %d for one client, %d clients congested" % (queues["queued_bytes"], queues["max_queued_bytes"], queues["congested"]),
+            "Commands: " + (", ".join(name + " " + str(count) for (name, count) in metrics.commands.most_common()) or "none"),
+        ]
+        if self.sessions != None:
+            lines.append("Sessions: %d, %d waiting to be resumed" % (len(self.sessions), self.sessions.suspendedCount()))
+        if self.limiter != None:
+            lines.append("Rate limited: " + (", ".join(outcome + " " + command + " " + str(count) for ((outcome, command), count) in sorted(self.limiter.counts.items())) or "none"))
+
+        self.sendToUser("\nServer stats:\n    " + "\n    ".join(lines), socket.name)
+
+    @commands.command("whisper", usage="whisper <user> <message>", split=1, minimum=2,
+                      help="Send a private message to a specified user, private messages can only be seen by you and the specified recipient")
+    def commandWhisper(self, socket, args):
+        (target_user, target_message) = args
+        self.sendToUser(target_message, target_user, socket.name)
+
+    @commands.command("disconnect", help="Disconnects from the server.")
+    def commandDisconnect(self, socket, args):
+        socket.leaving = True
+        self.sendToUser("Disconnecting from server", socket.name)
+        self.sendToAll("User " + socket.name + " has disconnected.")
+        return False
         
-        # Provided command was not recognised
-        self.sendToUser("[SERVER] Command '" + command + "' was not recognised.", socket.name)
-        print("[" + time.strftime("%H:%M:%S") + "] Command '" + command + "' was not recognised.")
+    def channelName(self, name):
+        # '#Room' and 'room' are the same channel, returns None if not allowed
+        name = name.lstrip('#').lower()
+        if not name.isalnum() or len(name) > 16:
+            return None
+        return name
+
+    def replay(self, socket, room, count=None):
+        # The messages are copied out first, so nobody waits while they are sent
+        self.showMessages(socket, room, "recently", self.history.recent(room, count))
+
+    def showMessages(self, socket, room, when, messages):
+        where = "in #" + room if room != None else "to everyone"
+        if not messages:
+            self.sendToUser("No messages " + when + " " + where + ".", socket.name)
+            return
+
+        self.sendToUser(str(len(messages)) + " messages " + when + " " + where + ":", socket.name)
+        for message in messages:
+            socket.send(message)
+
+    def joinChannel(self, socket, channel):
+        if self.channels.join(channel, socket):
+            socket.channels.add(channel)
+            self.sendToChannel("User " + socket.name.upper() + " has joined the channel.", channel)
+
+        # Hidden code so the custom client can show where messages are going
+        socket.channel = channel
+        self.sendToUser("400 #" + channel, socket.name, hidden=True)
+        self.sendToUser("You are now talking in #" + channel + ", use /all to reach everyone.", socket.name)
+        if self.replayOnJoin > 0:
+            self.replay(socket, channel, self.replayOnJoin)
+
+    def partChannel(self, socket, channel):
+        self.leaveChannel(socket, channel)
+        self.sendToChannel("User " + socket.name.upper() + " has left the channel.", channel)
+
+        if socket.channel == channel:
+            # Carry on in another channel if still in one
+            socket.channel = min(socket.channels) if socket.channels else None
+            if socket.channel != None:
+                self.sendToUser("400 #" + socket.channel, socket.name, hidden=True)
+                self.sendToUser("You left #" + channel + " and are now talking in #" + socket.channel + ".", socket.name)
+            else:
+                self.sendToUser("400", socket.name, hidden=True)
+                self.sendToUser("You left #" + channel + ", your messages now go to everyone.", socket.name)
+        else:
+            self.sendToUser("You left #" + channel + ".", socket.name)
+
+    def sendToChannel(self, message_body, channel, sender=None):
+        if sender == None:
+            tag = "[#" + channel + "]"
+        else:
+            tag = "[#" + channel + " - " + sender.upper() + "]"
+
+        message = (tag + " " + message_body).encode()
+
+        if sender != None and self.archive != None:
+            self.archive.append("#" + channel, message)
+
+        self.deliverToChannel(message, channel, sender)
+        if self.bus != None:
+            self.bus.channel(message, channel, sender)
+
         return True
-        
+
+    def deliverToChannel(self, message, channel, sender=None):
+        # Send to the channel's members connected to this process, except the sender
+        message = Message(message)
+        skip = self.clients.get(sender) if sender != None else None
+        members = self.channels.members(channel)
+        self.metrics.fanout.observe(len(members))
+
+        # Channels with nobody here have no scrollback to add to
+        if sender != None and members:
+            self.history.record(channel, message)
+
+        for client in members:
+            if client is not skip:
+                client.send(message)
+
+    def leaveChannel(self, socket, channel):
+        self.channels.part(channel, socket)
+        socket.channels.discard(channel)
+
+        # A channel goes once everyone has left, and its scrollback with it
+        if not self.channels.members(channel):
+            self.history.forget(channel)
+
     def sendToAll(self, message_body, sender=None):
         tag = ""
         
@@ -133,12 +567,30 @@ class EchoServer(Server):
 
         message = (tag + " " + message_body).encode()
 
-        for client in self.client_sockets:
-            if client.name != sender:
-                client.send(message)
+        if sender != None and self.archive != None:
+            self.archive.append("", message)
+
+        self.deliverToAll(message, sender)
+        if self.bus != None:
+            self.bus.broadcast(message, sender)
 
         return True
 
+    def deliverToAll(self, message, sender=None):
+        # Send to every client connected to this process except the sender,
+        # framing the message once for all of them
+        message = Message(message)
+        skip = self.clients.get(sender) if sender != None else None
+        if sender != None:
+            self.history.record(None, message)
+
+        recipients = self.clients.sockets()
+        self.metrics.fanout.observe(len(recipients))
+
+        for client in recipients:
+            if client is not skip:
+                client.send(message)
+
     def sendToUser(self, message_body, recipient, sender=None, hidden=False):
         tag = ""
 
@@ -149,40 +601,223 @@ class EchoServer(Server):
 
         message = (tag + " " + message_body).encode()
 
-        for client in self.client_sockets:
-            if client.name == recipient:
-                if hidden == True:
-                    # If hidden just send the message body and the client will know not to dispaly it
-                    client.send(message_body.encode())
-                else:
-                    client.send(message)   
-                return True
+        if hidden == True:
+            # If hidden just send the message body and the client will know not to dispaly it
+            message = message_body.encode()
+
+        # The recipient may be connected to another process
+        if self.deliverToUser(message, recipient) or (self.bus != None and self.bus.whisper(message, recipient)):
+            # Private messages are kept too, but never shown by /history
+            if sender != None and self.archive != None:
+                self.archive.append("@" + recipient.lower(), message)
+            return True
             
         # If code is here then recipient was not found so notify the sender
         # If the private message was sent by server in this case the recipient 
         # will almost always be connected so getting to this point is unlikely
         if sender != None:
-            for client in self.client_sockets:
-                if client.name == sender:
-                    client.send(("User " + recipient.upper() + " is not currently connected, your message was not sent.").encode())
+            self.deliverToUser(("User " + recipient.upper() + " is not currently connected, your message was not sent.").encode(), sender)
 
         return False
 
+    def deliverToUser(self, message, recipient):
+        # Send to the named client if it is connected to this process
+        client = self.clients.get(recipient)
+        if client == None:
+            return False
+
+        client.send(message)
+        return True
+
+    def onStop(self):
+        if self.bus != None:
+            self.bus.stop()
+        if self.archive != None:
+            self.archive.stop()
+        if self.deferred != None:
+            self.deferred.stop()
+        self.metrics.stop()
+        self.log.info("server_stopped")
+        self.log.stop()
+
+    def onError(self, socket, error):
+        # A command or plugin failed, only this connection is closed
+        frame = traceback.extract_tb(error.__traceback__)[-1]
+        self.log.error("handler_error", conn=socket.id, user=socket.name, error=repr(error),
+                       at=os.path.basename(frame.filename) + ":" + str(frame.lineno))
+        socket.leaving = True
+
+    def onCaughtUp(self, socket, dropped):
+        self.log.warning("fell_behind", conn=socket.id, user=socket.name, dropped=dropped)
+        socket.send(("[SERVER] Your connection fell behind, " + str(dropped) + " messages were not delivered.").encode())
+
     def onDisconnect(self, socket):
-        self.sendToUser("200", socket.name, hidden=True)
+        if self.limiter != None:
+            # Anything still held back is dropped
+            socket.gone = True
         
-        self.connections -= 1
-        print("[" + time.strftime("%H:%M:%S") + "] User " + socket.name + " disconnected. " + str(self.connections) + " clients now connected.")
-        self.client_names.remove(socket.name)
-        self.client_sockets.remove(socket)
+        with self.clients_lock:
+            self.connections -= 1
+            connections = self.connections
+
+        if socket.session != None:
+            if socket.leaving:
+                current = self.sessions.end(socket)
+            else:
+                current = self.sessions.suspend(socket)
+
+            if not current:
+                # Resumed on another connection, which has taken its place
+                self.log.info("disconnect", conn=socket.id, user=socket.name, connections=connections, resumed=True)
+                return
+            if not socket.leaving:
+                # Still connected as far as anyone else can tell
+                self.log.info("suspend", conn=socket.id, user=socket.name, connections=connections, evicted=socket.evicted)
+                return
+
+        self.sendToUser("200", socket.name, hidden=True)
+        self.removeClient(socket)
+        self.log.info("disconnect", conn=socket.id, user=socket.name, connections=connections, evicted=socket.evicted)
+
+    def expireSession(self, socket):
+        # Nobody came back for a suspended session
+        self.removeClient(socket)
+        self.log.info("session_expired", conn=socket.id, user=socket.name)
+
+    def removeClient(self, socket):
+        self.presence.unsubscribe(socket)
+
+        # Clients that never picked a name were never registered
+        if socket.assigned_name:
+            self.clients.remove(socket.name, socket)
+            if self.bus == None:
+                self.presence.publish(socket.name, False)
+
+        # Only the channels this client was in need updating
+        for channel in list(socket.channels):
+            self.leaveChannel(socket, channel)
+
+        if socket.assigned_name and self.bus != None:
+            self.bus.release(socket.name)
         
-	
-# Parse the IP address and port you wish to listen on.
-ip = sys.argv[1]
-port = int(sys.argv[2])
 
-# Create an echo server.
-server = EchoServer()
 
-# Start server
-server.start(ip, port)
\ No newline at end of file
+def createServer(args):
+    # Create an echo server.
+    server = EchoServer()
+    server.sendHighWater = args.queue_limit * 1024
+    server.sendLowWater = server.sendHighWater // 4
+    server.slowPeerPolicy = args.slow_clients
+    server.maxConnections = args.max_connections
+    server.listenBacklog = args.backlog
+    server.busyMessage = "[SERVER] The server is full, please try again later".encode()
+    server.logLevel = eventlog.LEVELS[args.log_level]
+    server.logSample = dict(args.log_sample)
+    server.logFormat = args.log_format
+    server.historyDepth = args.history
+    server.historyBytes = args.history_kb * 1024
+    server.replayOnJoin = args.replay
+    server.archiveDirectory = args.archive
+    server.lineLimit = args.rate_limit
+    server.commandLimits = dict(args.command_limit)
+    server.floodPolicy = args.flood_policy
+    server.floodHeld = args.flood_queue
+    server.adminPassword = args.admin_password
+    server.metricsPort = args.metrics_port
+    server.sessionTimeout = args.resume_seconds
+    server.sessionMessages = args.resume_messages
+    server.archiveSegmentBytes = args.archive_segment_mb << 20
+    server.archiveSyncInterval = args.archive_sync_ms / 1000
+    return server
+
+
+def limit(text):
+    # "5/10" -> (5.0, 10.0)
+    try:
+        return parseLimit(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected RATE or RATE/BURST, such as 5/10")
+
+
+def commandLimit(text):
+    # "all=1/3" -> ("all", (1.0, 3.0))
+    (name, _, text) = text.partition("=")
+    return (name.lstrip("/").lower(), limit(text))
+
+
+def sampling(text):
+    # "message=100" -> ("message", 100)
+    (event, _, every) = text.partition("=")
+    if not every.isdigit() or int(every) < 1:
+        raise argparse.ArgumentTypeError("expected EVENT=N, such as message=100")
+    return (event, int(every))
+
+
+if __name__ == "__main__":
+    # Parse the IP address and port you wish to listen on.
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("ip")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--eventloop", action="store_true",
+                        help="serve all connections from a single thread instead of one thread per connection")
+    parser.add_argument("--queue-limit", type=int, default=1024,
+                        help="KB of unsent messages a client may have waiting before --slow-clients applies, until it drains to a quarter of that")
+    parser.add_argument("--slow-clients", choices=["drop", "notify", "disconnect"], default="disconnect",
+                        help="drop messages to clients over the limit, drop them and say how many were missed, or disconnect them")
+    parser.add_argument("--max-connections", type=int, default=1000,
+                        help="turn away new clients while this many are connected")
+    parser.add_argument("--backlog", type=int, default=128,
+                        help="connections the OS may queue up before they are accepted")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="run this many server processes on the same port, sharing one set of users")
+    parser.add_argument("--history", type=int, default=100,
+                        help="recent messages kept for /history, per channel and for messages to everyone, 0 to keep none")
+    parser.add_argument("--history-kb", type=int, default=64,
+                        help="KB of recent messages kept per channel and for messages to everyone")
+    parser.add_argument("--replay", type=int, default=0,
+                        help="show this many recent messages to users when their name is accepted or they join a channel")
+    parser.add_argument("--archive", metavar="DIRECTORY",
+                        help="keep every message in log files in this directory, so they survive a restart")
+    parser.add_argument("--archive-segment-mb", type=int, default=16,
+                        help="MB each archive file grows to before a new one is started")
+    parser.add_argument("--archive-sync-ms", type=int, default=200,
+                        help="most milliseconds of messages that may be lost if the machine crashes")
+    parser.add_argument("--rate-limit", type=limit, metavar="RATE[/BURST]",
+                        help="lines a second each client may send, in bursts of up to BURST (default twice RATE)")
+    parser.add_argument("--command-limit", type=commandLimit, action="append", default=[], metavar="COMMAND=RATE[/BURST]",
+                        help="limit a command for each client, 'message' for plain messages, can be given more than once")
+    parser.add_argument("--flood-policy", choices=["queue", "drop", "disconnect"], default="queue",
+                        help="delay lines over a limit until they are allowed, drop them, or disconnect the client")
+    parser.add_argument("--flood-queue", type=int, default=50,
+                        help="lines over a limit held back per client with --flood-policy queue, any more are dropped")
+    parser.add_argument("--admin-password",
+                        help="password for /admin, which lets a user see /stats")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve metrics for Prometheus at http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--resume-seconds", type=int, default=30,
+                        help="hold a dropped client's name and messages this long for it to reconnect, 0 to let it go at once")
+    parser.add_argument("--resume-messages", type=int, default=1000,
+                        help="messages kept per client to send again when it reconnects")
+    parser.add_argument("--plugin", action="append", default=[], metavar="MODULE",
+                        help="import a module and add the commands from its register(commands) function, can be given more than once")
+    parser.add_argument("--log-level", choices=list(eventlog.LEVELS), default="info",
+                        help="least severe events to log, debug includes every message and command")
+    parser.add_argument("--log-sample", type=sampling, action="append", default=[], metavar="EVENT=N",
+                        help="only log one in every N of an event, can be given more than once")
+    parser.add_argument("--log-format", choices=["text", "json"], default="text",
+                        help="write log records as text or as one JSON object per line")
+    args = parser.parse_args()
+
+    if args.archive != None and args.workers > 1:
+        parser.error("--archive cannot be used with --workers, each process would need a log of its own")
+    if args.metrics_port != None and args.workers > 1:
+        parser.error("--metrics-port cannot be used with --workers, each process would need a port of its own")
+
+    for plugin in args.plugin:
+        importlib.import_module(plugin).register(EchoServer.commands)
+
+    if args.workers > 1:
+        cluster.serve(lambda: createServer(args), args.ip, args.port, args.workers, eventLoop=args.eventloop)
+    else:
+        # Start server
+        createServer(args).start(args.ip, args.port, eventLoop=args.eventloop)
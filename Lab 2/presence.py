@@ -0,0 +1,81 @@
+"""
+Who is connected to myserver.py, as a feed clients can follow.
+
+Every user joining or leaving bumps a version number. A subscriber is sent
+the full list of names once, as the hidden line
+
+    500 <version> <name>,<name>,...
+
+and from then on only the changes, one hidden line each:
+
+    501 <version> +<name>        joined
+    501 <version> -<name>        left
+
+Versions go up by one per change, so a client holding its own copy of the
+list can tell it missed one and ask for the full list again. Changes at or
+below the version it already has can be ignored.
+"""
+
+import threading
+from ex2utils import Message
+
+
+SNAPSHOT = "500"
+CHANGE = "501"
+
+
+class Presence:
+    """
+    The subscribers to the presence feed and the current version.
+
+    names is called for the full list when a socket subscribes. With several
+    worker processes the versions come from the hub instead, and are passed
+    to publish() and subscribe() as they arrive. Safe to use from several
+    threads.
+    """
+
+    def __init__(self, names):
+        self.names = names
+        self.lock = threading.Lock()
+        self.version = 0
+
+        # {socket: None}, used as an ordered set
+        self.subscribers = {}
+
+    def subscribe(self, socket, snapshot=None):
+        """
+        Send socket the full list, then every change after it. snapshot is
+        (version, names) when the list comes from elsewhere.
+        """
+        with self.lock:
+            # Taken under the lock so no change can fall between the list
+            # and the first change sent after it
+            (version, names) = snapshot if snapshot != None else (self.version, self.names())
+            self.subscribers[socket] = None
+            socket.send((SNAPSHOT + " " + str(version) + " " + ",".join(names)).encode())
+
+    def unsubscribe(self, socket):
+        """Stop sending socket changes, returns False if it was not subscribed."""
+        with self.lock:
+            return self.subscribers.pop(socket, False) == None
+
+    def transfer(self, old, new):
+        """Send the changes old was following to new instead, with no new list."""
+        with self.lock:
+            if self.subscribers.pop(old, False) == None:
+                self.subscribers[new] = None
+
+    def publish(self, name, joined, version=None):
+        """Tell every subscriber name has joined or left."""
+        with self.lock:
+            self.version = version if version != None else self.version + 1
+            if not self.subscribers:
+                return
+
+            # Framed once for everyone
+            message = Message((CHANGE + " " + str(self.version) + " " + ("+" if joined else "-") + name).encode())
+            for socket in self.subscribers:
+                socket.send(message)
+
+    def __len__(self):
+        return len(self.subscribers)
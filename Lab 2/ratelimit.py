@@ -0,0 +1,198 @@
+"""
+Flood control for myserver.py.
+"""
+
+import time, heapq, threading, collections
+
+
+class TokenBucket:
+    """
+    Allows rate events a second on average, and bursts of up to burst.
+
+    Checking and taking a token is a few arithmetic operations on the
+    bucket's own fields, nothing is allocated.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def ready(self, now):
+        """Refill for the time passed, returns True if a token is available."""
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        self.tokens = tokens if tokens < self.burst else self.burst
+        self.stamp = now
+        return self.tokens >= 1
+
+    def take(self):
+        # Only after ready() has returned True
+        self.tokens -= 1
+
+    def delay(self):
+        """Seconds until the next token, as of the last ready()."""
+        return max(1 - self.tokens, 0) / self.rate
+
+
+def parseLimit(text):
+    """'5' or '5/10' -> (rate, burst), burst defaults to twice the rate."""
+    (rate, _, burst) = text.partition("/")
+    rate = float(rate)
+    burst = float(burst) if burst else max(rate * 2, 1)
+    if rate <= 0 or burst < 1:
+        raise ValueError("limits need a rate above 0 and a burst of at least 1")
+    return (rate, burst)
+
+
+class Deferred:
+    """
+    Holds back lines that went over a limit and hands them back in order
+    once the client has tokens again.
+
+    Each connection keeps its own queue. A line stays at the front of the
+    queue while it is being handled, so a line arriving meanwhile is queued
+    behind it rather than overtaking it. One thread serves every connection.
+    """
+
+    def __init__(self, handle, onError):
+        # handle(socket, line, parsed) processes a line, returning False to
+        # disconnect. onError(socket, error) is told if it raises, and the
+        # socket is then disconnected as well
+        self.handle = handle
+        self.onError = onError
+        self.condition = threading.Condition()
+
+        # (due, sequence, socket), earliest first
+        self.timers = []
+        self.sequence = 0
+        self.running = True
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def waiting(self, socket):
+        """True if socket has lines held back, new lines must queue behind them."""
+        return bool(socket.held)
+
+    def hold(self, socket, kind, line, parsed, delay):
+        """Hold a line back, kind is what it counts against as for Limiter.check()."""
+        with self.condition:
+            socket.held.append((kind, line, parsed))
+            if len(socket.held) == 1:
+                self.schedule(socket, delay)
+
+    def schedule(self, socket, delay):
+        # Called holding the condition
+        self.sequence += 1
+        heapq.heappush(self.timers, (time.monotonic() + delay, self.sequence, socket))
+        self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.timers or self.timers[0][0] > time.monotonic()):
+                    self.condition.wait(self.timers[0][0] - time.monotonic() if self.timers else None)
+                if not self.running:
+                    return
+                (due, sequence, socket) = heapq.heappop(self.timers)
+
+            self.release(socket)
+
+    def release(self, socket):
+        # Handle as many held lines as the socket's limits now allow
+        while not socket.gone:
+            with self.condition:
+                if not socket.held:
+                    return
+                (kind, line, parsed) = socket.held[0]
+                delay = socket.limiter.check(socket, kind)
+                if delay > 0:
+                    self.schedule(socket, delay)
+                    return
+
+            try:
+                result = self.handle(socket, line, parsed)
+            except Exception as error:
+                self.onError(socket, error)
+                result = False
+
+            if result == False:
+                socket.disconnect()
+                socket.gone = True
+
+            with self.condition:
+                socket.held.popleft()
+
+        with self.condition:
+            socket.held.clear()
+
+
+class Limiter:
+    """
+    Per-connection limits, for every line and for particular commands.
+
+    commands maps a command name, or "message" for plain messages, to its
+    (rate, burst). policy says what happens to lines over a limit: 'queue'
+    holds them until they are allowed (at most maxHeld per connection, any
+    more are dropped), 'drop' discards them and 'disconnect' closes the
+    connection. counts records how many lines each command had limited.
+    """
+
+    # Seconds between notices to a client about being limited
+    noticeInterval = 5
+
+    def __init__(self, connection=None, commands=None, policy="queue", maxHeld=50):
+        self.connection = connection
+        self.commands = commands or {}
+        self.policy = policy
+        self.maxHeld = maxHeld
+        self.counts = collections.Counter()
+
+    def attach(self, socket):
+        """Give a new connection its buckets, so checks never create any."""
+        socket.limiter = self
+        socket.lineBucket = TokenBucket(*self.connection) if self.connection != None else None
+        socket.commandBuckets = {name: TokenBucket(*limit) for (name, limit) in self.commands.items()}
+        socket.noticeBucket = TokenBucket(1 / self.noticeInterval, 1)
+        socket.held = collections.deque()
+        socket.gone = False
+
+    def check(self, socket, kind):
+        """
+        Seconds until a line is allowed, taking its tokens if it is allowed
+        now. kind is the line's command name, "message" for a plain message or
+        None for a name, worked out once by the caller.
+        """
+        now = time.monotonic()
+        lineBucket = socket.lineBucket
+        commandBucket = socket.commandBuckets.get(kind) if socket.commandBuckets else None
+
+        delay = 0
+        if lineBucket != None and not lineBucket.ready(now):
+            delay = lineBucket.delay()
+        if commandBucket != None and not commandBucket.ready(now):
+            delay = max(delay, commandBucket.delay())
+        if delay > 0:
+            return delay
+
+        if lineBucket != None:
+            lineBucket.take()
+        if commandBucket != None:
+            commandBucket.take()
+        return 0
+
+    def notice(self, socket):
+        """True if the client may be told about being limited again."""
+        if not socket.noticeBucket.ready(time.monotonic()):
+            return False
+        socket.noticeBucket.take()
+        return True
@@ -0,0 +1,146 @@
+"""
+Connected users for myserver.py, looked up by name.
+"""
+
+import threading
+
+
+class Registry:
+    """
+    Maps names to sockets, comparing names case-insensitively.
+
+    Adding, removing and finding a user take the same time however many are
+    connected. Iterating gives users in the order they joined, from a snapshot
+    that is only rebuilt after someone joins or leaves, so a broadcast does not
+    copy the whole list each time. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # Folded name -> socket, dicts keep insertion order
+        self.users = {}
+
+        # Tuple of sockets, None when out of date
+        self.snapshot = None
+
+    @staticmethod
+    def key(name):
+        return name.casefold()
+
+    def add(self, name, socket, welcome=None):
+        """
+        Register socket under name, returns False if the name is already taken.
+        welcome(), if given, is called just before anyone else can find the
+        socket, so whatever it sends arrives ahead of any message to the user.
+        """
+        key = self.key(name)
+        with self.lock:
+            if key in self.users:
+                return False
+            if welcome != None:
+                welcome()
+            self.users[key] = socket
+            self.snapshot = None
+        return True
+
+    def remove(self, name, socket):
+        """Forget name, if it still belongs to socket."""
+        key = self.key(name)
+        with self.lock:
+            if self.users.get(key) is socket:
+                del self.users[key]
+                self.snapshot = None
+
+    def replace(self, name, old, new):
+        """Register new in place of old, returns False if name does not belong to old."""
+        key = self.key(name)
+        with self.lock:
+            if self.users.get(key) is not old:
+                return False
+            self.users[key] = new
+            self.snapshot = None
+        return True
+
+    def get(self, name):
+        """The socket registered under name, or None."""
+        return self.users.get(self.key(name))
+
+    def names(self):
+        with self.lock:
+            return [socket.name for socket in self.users.values()]
+
+    def sockets(self):
+        """Every registered socket, in the order they joined."""
+        snapshot = self.snapshot
+        if snapshot == None:
+            with self.lock:
+                snapshot = self.snapshot = tuple(self.users.values())
+        return snapshot
+
+    def __iter__(self):
+        return iter(self.sockets())
+
+    def __contains__(self, name):
+        return self.key(name) in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+
+class Channels:
+    """
+    Channel name -> members, so a message to a channel only goes through the
+    people in it.
+
+    Members are kept in the order they joined. Each channel's member list is
+    snapshotted the same way as Registry's, and a channel is dropped once its
+    last member leaves. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # Channel -> {socket: None}, used as an ordered set
+        self.channels = {}
+
+        # Channel -> tuple of members, missing when out of date
+        self.snapshots = {}
+
+    def join(self, channel, socket):
+        """Add socket to channel, returns False if it was already a member."""
+        with self.lock:
+            members = self.channels.setdefault(channel, {})
+            if socket in members:
+                return False
+            members[socket] = None
+            self.snapshots.pop(channel, None)
+        return True
+
+    def part(self, channel, socket):
+        """Remove socket from channel, returns False if it was not a member."""
+        with self.lock:
+            members = self.channels.get(channel)
+            if members == None or socket not in members:
+                return False
+            del members[socket]
+            if not members:
+                del self.channels[channel]
+            self.snapshots.pop(channel, None)
+        return True
+
+    def members(self, channel):
+        """Everyone in channel, in the order they joined."""
+        snapshot = self.snapshots.get(channel)
+        if snapshot == None:
+            with self.lock:
+                members = self.channels.get(channel)
+                if members == None:
+                    return ()
+                snapshot = self.snapshots[channel] = tuple(members)
+        return snapshot
+
+    def sizes(self):
+        """Channel -> number of members, for every channel with anyone in it."""
+        with self.lock:
+            return {channel: len(members) for (channel, members) in self.channels.items()}
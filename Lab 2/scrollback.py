@@ -0,0 +1,58 @@
+"""
+Recent messages for myserver.py, kept per room so they can be shown again.
+"""
+
+import threading, itertools, collections
+
+
+class Scrollback:
+    """
+    The last messages sent in each room, at most depth of them and at most
+    maxBytes of message text per room, whichever is reached first.
+
+    Rooms are channel names, with None for messages to everyone. Messages are
+    kept as the ex2utils.Message that was sent, so showing them again reuses
+    the framing already built. Safe to use from several threads.
+    """
+
+    def __init__(self, depth=100, maxBytes=65536):
+        self.depth = depth
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+
+        # Room -> [deque of messages, bytes held]
+        self.rooms = {}
+
+    def record(self, room, message):
+        if self.depth <= 0:
+            return
+
+        size = len(message.body)
+        with self.lock:
+            entry = self.rooms.get(room)
+            if entry == None:
+                entry = self.rooms[room] = [collections.deque(), 0]
+            (messages, held) = entry
+
+            messages.append(message)
+            held += size
+
+            # Oldest go first
+            while len(messages) > self.depth or (held > self.maxBytes and len(messages) > 1):
+                held -= len(messages.popleft().body)
+            entry[1] = held
+
+    def recent(self, room, count=None):
+        """Up to count of the newest messages in room, oldest first."""
+        with self.lock:
+            entry = self.rooms.get(room)
+            if entry == None:
+                return []
+            messages = entry[0]
+            if count == None or count >= len(messages):
+                return list(messages)
+            return list(itertools.islice(messages, len(messages) - max(count, 0), None))
+
+    def forget(self, room):
+        with self.lock:
+            self.rooms.pop(room, None)
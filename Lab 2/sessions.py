@@ -0,0 +1,116 @@
+"""
+Resumable sessions for myserver.py.
+
+Each client that sends /session before its name gets a session with a
+random token, sent along with the 100 code that accepts their name, and a
+Journal numbering and keeping the last messages sent to them. If the connection drops without /disconnect
+the session is held for a while, the user staying connected as far as
+everyone else can tell. A new connection sending
+
+    /resume <token> <messages received>
+
+instead of a name takes over the session and is sent everything it missed.
+"""
+
+import secrets, threading
+from ex2utils import Journal
+
+
+class Session:
+    """One named client's token, journal and the socket it is on."""
+
+    __slots__ = ("token", "journal", "socket", "suspended")
+
+    def __init__(self, token, journal, socket):
+        self.token = token
+        self.journal = journal
+        self.socket = socket
+
+        # The timer that will expire it while suspended, otherwise None
+        self.suspended = None
+
+
+class Sessions:
+    """
+    Every session by token, holding on to suspended ones for timeout seconds
+    before expire(socket) is called to let the user go. Journals keep the
+    last size messages. Safe to use from several threads.
+    """
+
+    def __init__(self, timeout, size, expire):
+        self.timeout = timeout
+        self.size = size
+        self.expire = expire
+        self.lock = threading.Lock()
+
+        # Token -> Session
+        self.sessions = {}
+
+    def start(self, socket):
+        """Start a session for socket, returns its token."""
+        token = secrets.token_hex(16)
+        session = Session(token, Journal(self.size), socket)
+        session.journal.attach(socket)
+        socket.session = session
+        with self.lock:
+            self.sessions[token] = session
+        return token
+
+    def suspend(self, socket):
+        """Hold socket's session for a new connection, returns False if it has already moved to one."""
+        session = socket.session
+        with self.lock:
+            if session.socket is not socket:
+                return False
+            session.journal.detach(socket)
+            timer = session.suspended = threading.Timer(self.timeout, self.expired, (session,))
+
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def end(self, socket):
+        """Forget socket's session, returns False if it has already moved to another socket."""
+        session = socket.session
+        with self.lock:
+            if session.socket is not socket:
+                return False
+            self.sessions.pop(session.token, None)
+        return True
+
+    def resume(self, token, socket, received, greeting):
+        """
+        Move the session with token to socket, sending it whatever it missed
+        after greeting(first), see Journal.attach. Returns (the socket it
+        was on, the number of the first message resent), or None if there
+        is no such session.
+        """
+        with self.lock:
+            session = self.sessions.get(token)
+            if session == None:
+                return None
+
+            previous = session.socket
+            session.socket = socket
+            if session.suspended != None:
+                session.suspended.cancel()
+                session.suspended = None
+            socket.session = session
+            first = session.journal.attach(socket, received, greeting)
+        return (previous, first)
+
+    def expired(self, session):
+        with self.lock:
+            # Runs on the timer's own thread, which is not the one to go by
+            # if the session has been resumed since, and maybe suspended again
+            if session.suspended is not threading.current_thread() or self.sessions.get(session.token) is not session:
+                return
+            del self.sessions[session.token]
+        self.expire(session.socket)
+
+    def suspendedCount(self):
+        with self.lock:
+            return sum(1 for session in self.sessions.values() if session.suspended != None)
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,117 @@
+"""
+Line editing for myclient.py, so messages arriving while the user types do
+not break up what they are typing.
+
+On a terminal, stdin is switched to cbreak mode and the line being typed is
+kept here rather than by the terminal. Showing a message clears the input
+line, writes the message, then draws the prompt and the text typed so far
+again underneath. Without a terminal (input piped in) lines are read as
+they arrive and nothing is redrawn.
+
+Works wherever stdin can be waited on with selectors, so not on Windows.
+"""
+
+import os, sys, codecs
+
+try:
+    import termios, tty
+except ImportError:
+    termios = None
+
+
+class Terminal:
+    """The input line and prompt, read from stdin whenever it is readable."""
+
+    def __init__(self, stdin=None, stdout=None):
+        self.stdin = stdin if stdin != None else sys.stdin
+        self.stdout = stdout if stdout != None else sys.stdout
+        self.fd = self.stdin.fileno()
+        self.interactive = termios != None and os.isatty(self.fd)
+
+        self.prompt = ""
+        self.line = ""
+
+        # Keys can arrive split across reads, as can UTF-8 characters
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.escape = None
+        self.saved = None
+
+        # Set at the end of input. Lines finished before a Ctrl-D are handed
+        # back first, and the end only by the next read()
+        self.ended = False
+
+    def __enter__(self):
+        if self.interactive:
+            self.saved = termios.tcgetattr(self.fd)
+            tty.setcbreak(self.fd)
+        return self
+
+    def __exit__(self, *exception):
+        if self.saved != None:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved)
+            self.write("\n")
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Take what is waiting on stdin, returns the lines finished, or None at the end of input."""
+        if self.ended:
+            return None
+
+        data = os.read(self.fd, 4096)
+        if not data:
+            self.ended = True
+            return None
+
+        lines = []
+        echo = ""
+        for char in self.decoder.decode(data):
+            if self.escape != None:
+                # Skip arrow keys and the like, up to the final character
+                self.escape += char
+                if self.escape[0] not in "[O" or (len(self.escape) > 1 and "@" <= char <= "~"):
+                    self.escape = None
+            elif char == "\x1b":
+                self.escape = ""
+            elif char == "\n" or (char == "\r" and self.interactive):
+                lines.append(self.line)
+                self.line = ""
+                echo += "\n" + self.prompt
+            elif char == "\x04" and self.interactive and not self.line:
+                # Ctrl-D on an empty line, anything typed after it is ignored
+                self.ended = True
+                break
+            elif char in "\x7f\b":
+                if self.line:
+                    self.line = self.line[:-1]
+                    echo += "\b \b"
+            elif char == "\x15":
+                # Ctrl-U clears the line
+                self.line = ""
+                echo += "\r\x1b[K" + self.prompt
+            elif char.isprintable():
+                self.line += char
+                echo += char
+
+        if self.interactive:
+            self.write(echo)
+        if self.ended and not lines:
+            return None
+        return lines
+
+    def show(self, text):
+        """Write a line of output above the line being typed."""
+        if self.interactive:
+            self.write("\r\x1b[K" + text + "\n" + self.prompt + self.line)
+        else:
+            self.write(text + "\n")
+
+    def setPrompt(self, prompt):
+        self.prompt = prompt
+        if self.interactive:
+            self.write("\r\x1b[K" + prompt + self.line)
+
+    def write(self, text):
+        self.stdout.write(text)
+        self.stdout.flush()